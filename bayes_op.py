@@ -2,8 +2,9 @@ import gpytorch
 import numpy as np
 import torch
 from gp_utils import MultiTaskBoTorchGP, BoTorchGP
-import sobol_seq
 from gpytorch.kernels import MaternKernel, ScaleKernel
+from gpytorch.utils.cholesky import psd_safe_cholesky
+from botorch.generation.gen import gen_candidates_scipy
 import time
 from dataclasses import dataclass
 import math
@@ -31,9 +32,94 @@ TuRBO refers to the classical method of [Eriksson et al. 2019]
 """
 
 
+def prepare_lipschitz_grid(lipschitz_grid, pen_point, lengthscale):
+    '''
+    Centers the sobol grid around the penalty point, scales it by the lengthscales and clips it to the unit box.
+    All inputs are numpy arrays, so the whole construction is done in a few vectorized operations.
+    '''
+    grid = (lipschitz_grid - lipschitz_grid[0]) * lengthscale + pen_point
+    np.clip(grid, 0.0, 1.0, out = grid)
+    return grid
+
+
+@torch.jit.script
+def min_ucb(means, stds, beta, bias):
+    '''
+    Calculates the upper confidence bound of every fidelity from the stacked (M, N) means and standard deviations,
+    and returns its minimum over the fidelities.
+    '''
+    ucb = means + beta.unsqueeze(1) * stds + bias.unsqueeze(1)
+    return torch.min(ucb, dim = 0)[0]
+
+
+@torch.jit.script
+def penalise_ucb(ucb, penalty_points, X, denominator):
+    '''
+    Multiplies the (N,) ucb by the local penalisers of the (B, d) penalty points, whose (B,) denominators are
+    r_j + gamma * std_j / L_j.
+    '''
+    penaliser = torch.clamp(torch.cdist(penalty_points, X) / denominator.unsqueeze(1), max = 1.0)
+    return ucb * penaliser.prod(dim = 0)
+
+
+INV_SQRT_2PI = 1.0 / math.sqrt(2.0 * math.pi)
+# the gaussian entropy constants, H = log(sigma * sqrt(2 pi e)) = log(sigma) + 0.5 * log(2 pi e)
+SQRT_2PI_E = math.sqrt(2.0 * math.pi * math.e)
+HALF_LOG_2PIE = 0.5 * math.log(2.0 * math.pi * math.e)
+# log normalising constant of the standard normal pdf
+HALF_LOG_2PI = 0.5 * math.log(2.0 * math.pi)
+
+
+def std_normal_cdf(x):
+    '''
+    Standard normal cdf through torch.special.ndtr, which stays accurate in the tails and avoids building a
+    torch.distributions.Normal for every call.
+    '''
+    return torch.special.ndtr(x)
+
+
+def std_normal_pdf(x):
+    '''
+    Closed-form standard normal pdf, avoids the log_prob and exp round trip.
+    '''
+    return INV_SQRT_2PI * torch.exp(-0.5 * x * x)
+
+
+def std_normal_log_cdf(x):
+    '''
+    Log of the standard normal cdf, finite far into the lower tail where the cdf itself underflows to 0. The argument
+    is clamped at -100, where the log cdf is already below -5000, because the gradient of log_ndtr turns into nans
+    and infs further into the tail.
+    '''
+    return torch.special.log_ndtr(x.clamp_min(-100.0))
+
+
+def std_normal_log_pdf(x):
+    '''
+    Closed-form log of the standard normal pdf.
+    '''
+    return -0.5 * x * x - HALF_LOG_2PI
+
+
+@torch.jit.script
+def gaussian_entropy_integral(f_range, scale, cdf_offset, cdf_slope, pdf_shift, pdf_scale):
+    '''
+    Trapezium rule estimate over f_range of the integral of g(f) * log(g(f)), where
+    g(f) = scale * Phi(cdf_offset - cdf_slope * f) * phi((f - pdf_shift) / pdf_scale) covers both Psi and nu.
+    The whole (integration steps, batch size, samples) grid is evaluated inside a single scripted call, working with
+    log(g) so that the tails never go through log(0).
+    '''
+    f = f_range.reshape(-1, 1, 1)
+    log_z = torch.log(scale) + std_normal_log_cdf(cdf_offset - cdf_slope * f) + std_normal_log_pdf((f - pdf_shift) / pdf_scale)
+    # exp(log_z) underflows to exactly 0 in the tails, which is the limit of x * log(x) as x -> 0
+    log_z = log_z.clamp_min(-1e30)
+    return torch.trapezoid(torch.exp(log_z) * log_z, f_range, dim = 0)
+
+
 class mfLiveBatch():
     def __init__(self, env, beta = None, fidelity_thresholds = None, lipschitz_constant = 1, num_of_starts = 75, num_of_optim_epochs = 25, \
-        hp_update_frequency = None, budget = 10, cost_budget = 4, initial_bias = 0.1, local_lipschitz = True, increasing_thresholds = False):
+        hp_update_frequency = None, budget = 10, cost_budget = 4, initial_bias = 0.1, local_lipschitz = True, increasing_thresholds = False, \
+        num_of_raw_samples = None, use_gpu = False, max_gp_points = None):
         '''
         Takes as inputs:
         env - optimization environment
@@ -42,6 +128,10 @@ class mfLiveBatch():
         num_of_starts - number of multi-starts for optimizing the acquisition function, default is 75
         num_of_optim_epochs - number of epochs for optimizing the acquisition function, default is 150
         hp_update_frequency - how ofter should GP hyper-parameters be re-evaluated, default is None
+        num_of_raw_samples - number of sobol points screened for the optimisation starts, at least 10, default is None, which uses 100 * num_of_starts * min(dim, 5)
+        use_gpu - if True and cuda is available, the acquisition function is evaluated on the gpu, default is False
+        max_gp_points - maximum number of observations each model is fitted on, default is None, which uses all of them.
+            Any other value changes the surrogate once a fidelity has more observations than it
         '''
         # initialise the environment
         self.env = env
@@ -56,20 +146,22 @@ class mfLiveBatch():
         # multifidelity parameters
         self.num_of_fidelities = self.env.num_of_fidelities
         if fidelity_thresholds is None:
-            self.fidelity_thresholds = [0.1 for _ in range(self.num_of_fidelities)]
-            self.fidelity_thresholds_init = [0.1 for _ in range(self.num_of_fidelities)]
-        else:
-            self.fidelity_thresholds = fidelity_thresholds
-            self.fidelity_thresholds_init = fidelity_thresholds.copy()
+            fidelity_thresholds = [0.1 for _ in range(self.num_of_fidelities)]
+        # thresholds are kept as arrays, so they can be updated and compared in place
+        self.fidelity_thresholds = np.asarray(fidelity_thresholds, dtype = np.float64).copy()
+        self.fidelity_thresholds_init = self.fidelity_thresholds.copy()
         self.increasing_thresholds = increasing_thresholds
         # check if we need to update the maximum bias or it is set by the user
         self.update_max_bias = True
         # costs thresholds to double the fidelity thresholds
-        self.cost_thresholds = [0] + [self.env.func.expected_costs[i] / self.env.func.expected_costs[i + 1] * self.cost_budget \
-             for i in range(self.num_of_fidelities - 1)]
+        self.cost_thresholds = np.array([0] + [self.env.func.expected_costs[i] / self.env.func.expected_costs[i + 1] * self.cost_budget \
+             for i in range(self.num_of_fidelities - 1)], dtype = np.float64)
+        # cost of querying each fidelity, and their expected costs
+        self.fidelity_costs = np.asarray(self.env.func.fidelity_costs, dtype = np.float64)
+        self.expected_costs = np.asarray(self.env.func.expected_costs, dtype = np.float64)
         
         # initialize count list
-        self.fidelity_count_list = [0 for _ in range(self.num_of_fidelities)]
+        self.fidelity_count_list = np.zeros(self.num_of_fidelities, dtype = np.int32)
         # initialize bias
         if type(initial_bias) in [float, int]:
             self.bias_list = [i for i in range(self.num_of_fidelities)]
@@ -81,7 +173,7 @@ class mfLiveBatch():
         self.set_hyperparams()
 
         # values of LP
-        if beta == None:
+        if beta is None:
             self.fixed_beta = False
             self.beta = [float(0.2 * self.dim * np.log(2 * (self.env.current_time + 1))) for _ in range(self.num_of_fidelities)]
         else:
@@ -93,11 +185,18 @@ class mfLiveBatch():
         # parameters of local penalization method
         self.lipschitz_constant = [lipschitz_constant for _ in range(self.num_of_fidelities)]
         self.max_value = [0 for _ in range(self.num_of_fidelities)]
+        # cache of the posterior at the penalty points, rebuilt whenever the batch or the models change
+        self.pp_cache = None
         # initialize grid to select lipschitz constant
         self.estimate_lipschitz = True
         self.local_lipschitz = local_lipschitz
         self.num_of_grad_points = 50 * self.dim
-        self.lipschitz_grid = sobol_seq.i4_sobol_generate(self.dim, self.num_of_grad_points)
+        # unscrambled sobol grid, skipping the origin so the first point is the centre of the unit box
+        lipschitz_sobol = torch.quasirandom.SobolEngine(self.dim, scramble = False)
+        lipschitz_sobol.fast_forward(1)
+        self.lipschitz_grid = lipschitz_sobol.draw(self.num_of_grad_points).double().numpy()
+        # the grid is fixed for the whole run, so keep a tensor view of it as well
+        self.lipschitz_grid_t = torch.from_numpy(self.lipschitz_grid).double()
         # do we require transform?
         if (self.env.func.require_transform == True):
             self.soft_plus_transform = True
@@ -107,11 +206,29 @@ class mfLiveBatch():
         # optimisation parameters
         self.num_of_starts = num_of_starts
         self.num_of_optim_epochs = num_of_optim_epochs
+        self.num_of_raw_samples = num_of_raw_samples
         self.grid_search = self.env.func.grid_search
         self.grid_to_search = None
+        # precision of the acquisition function evaluations, models are always fitted in float64
+        self.af_dtype = torch.float32
+        # device of the acquisition function evaluations, models are always fitted on the cpu
+        if use_gpu and torch.cuda.is_available():
+            self.device = torch.device('cuda:0')
+        else:
+            self.device = torch.device('cpu')
+        # pool of sobol points for the optimisation starts, redrawn every sobol_refresh_rate time-steps
+        self.sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
+        self.sobol_pool = None
+        self.sobol_pool_time = None
+        self.sobol_refresh_rate = 10
+        # optimised starts of the last optimise_af call, best first, and the minimum distance between batch queries
+        self.optimised_starts = np.empty((0, self.dim))
+        self.min_start_distance = 1e-3
         # hp hyperparameters update frequency
         self.hp_update_frequency = hp_update_frequency
         self.last_n_obs = [0 for _ in range(self.num_of_fidelities)]
+        # maximum number of observations each model is fitted on, None uses all of them
+        self.max_gp_points = max_gp_points
 
         # define domain
         self.domain = np.zeros((self.dim,))
@@ -129,7 +246,7 @@ class mfLiveBatch():
         mean_constant: float, value of prior mean
         constraints: boolean, if True, we will apply constraints from paper based on the given hyperparameters
         '''
-        if constant == None:
+        if constant is None:
             self.constant = 0.6
             self.length_scale = torch.tensor([0.15 for _ in range(self.dim)])
             self.noise = 1e-4
@@ -149,7 +266,7 @@ class mfLiveBatch():
     
     def initialise_stuff(self):
         # list of queries
-        self.queried_batch = [[]] * self.num_of_fidelities
+        self.queried_batch = [[] for _ in range(self.num_of_fidelities)]
         # list of queries and observations
         self.X = [[] for _ in range(self.num_of_fidelities)]
         self.Y = [[] for _ in range(self.num_of_fidelities)]
@@ -195,27 +312,29 @@ class mfLiveBatch():
         # check if we need to update beta
         # check if we need to update beta
         if self.fixed_beta == False:
-            beta = float(0.2 * self.dim * np.log(2 * (self.current_time / self.env.func.expected_costs[0]) + 1))
+            beta = 0.2 * self.dim * np.log(2 * (self.current_time / self.env.func.expected_costs[0]) + 1)
             self.beta = [beta for _ in range(self.num_of_fidelities)]
 
         # optimise acquisition function to obtain new queries until batch is full
 
         new_Xs = np.empty((0, self.dim))
         new_Ms = np.empty((0, 1))
+        new_X_list = []
+        new_M_list = []
         
         self.lipschitz_batch_list = []
         # obtain current batch
         self.current_batch = self.env.query_list.copy()
         self.current_batch_fids = self.env.fidelities_list.copy()
         if self.local_lipschitz:
-            for i, penalty_point_fidelity in enumerate(zip(self.current_batch, self.current_batch_fids)):
-                penalty_point = penalty_point_fidelity[0].reshape(1, -1)
-                fidelity = int(penalty_point_fidelity[1])
-                # re-define penalty point as tensor
-                penalty_point = torch.tensor(penalty_point)
-                # calculate local lipschitz constant
-                local_lip_constant = self.calculate_local_lipschitz(penalty_point, fidelity)
-                self.lipschitz_batch_list.append(local_lip_constant)
+            self.lipschitz_batch_list = [None for _ in range(self.current_batch.shape[0])]
+            batch_fids = self.current_batch_fids.reshape(-1).astype(int)
+            # estimate the local lipschitz constants of all penalty points of a fidelity at once
+            for fidelity in np.unique(batch_fids):
+                fid_idx = np.where(batch_fids == fidelity)[0]
+                local_lip_constants = self.calculate_local_lipschitz_batch(self.current_batch[fid_idx, :], fidelity)
+                for i, local_lip_constant in zip(fid_idx, local_lip_constants):
+                    self.lipschitz_batch_list[i] = local_lip_constant
         else:
             # otherwise simply append the global lipschitz constant for each fidelity
             batch = self.env.query_list
@@ -223,27 +342,34 @@ class mfLiveBatch():
             for i, penalty_point_fidelity in enumerate(zip(batch, batch_fids)):
                 fidelity = int(penalty_point_fidelity[1])
                 self.lipschitz_batch_list.append(self.lipschitz_constant[fidelity])
+        # cache the posterior at the penalty points
+        self.update_penalty_cache()
 
         # fill batch
         while self.batch_costs < self.cost_budget:
 #            self.lipshitz_batch_list = []
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            new_X_list.append(new_X)
+            new_M_list.append(new_M)
             # add new_X and new_M to current batch
             self.current_batch = np.concatenate((self.current_batch, new_X))
             self.current_batch_fids = np.concatenate((self.current_batch_fids, new_M))
             # update batch costs
-            self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
+            fidelity = int(new_M)
+            self.batch_costs = self.batch_costs + self.fidelity_costs[fidelity]
             # if loop is not going to break, add new lipschitz constant
             if self.batch_costs < self.cost_budget:
                 # new_M and new_X define the penalty point
-                fidelity = int(new_M)
-                penalty_point = torch.tensor(new_X)
+                penalty_point = new_X
                 # calculate local lipschitz constant
                 local_lip_constant = self.calculate_local_lipschitz(penalty_point, fidelity)
                 self.lipschitz_batch_list.append(local_lip_constant)
+                # the batch has changed, so re-cache the posterior at the penalty points
+                self.update_penalty_cache()
 
+        # stack the new queries once the batch is full
+        new_Xs = np.concatenate((new_Xs, *new_X_list))
+        new_Ms = np.concatenate((new_Ms, *new_M_list))
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
         # update model if there are new observations
@@ -255,7 +381,7 @@ class mfLiveBatch():
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 # if fidelity is not the lowest, check bias assumption. If broken, double the penalty.
@@ -277,16 +403,16 @@ class mfLiveBatch():
                             # calculate difference
                             diff = f_high_fid_obs - f_low_fid_pred
                             # append corresponding bias observations
-                            self.bias_X[lower_fid].append(list(obtain_query[i, :].reshape(-1)))
+                            self.bias_X[lower_fid].append(obtain_query[i, :].copy())
                             self.bias_Y[lower_fid].append(diff)
                             bias_updates.append(lower_fid)
                 # redefine new maximum value
                 self.max_value[fid] = float(max(self.max_value[fid], float(self.new_obs[i])))
                 # take away batch cost
-                self.batch_costs = self.batch_costs - self.env.func.fidelity_costs[fid]
+                self.batch_costs = self.batch_costs - self.fidelity_costs[fid]
 
             # check which model need to be updated according to the fidelities
-            update_set = set(obtain_fidelities.reshape(-1))
+            update_set = np.unique(obtain_fidelities.astype(np.int64))
             bias_update_set = set(bias_updates)
             self.update_model(update_set)
             self.update_model_bias(bias_update_set)
@@ -347,25 +473,51 @@ class mfLiveBatch():
         This function updates the GP model
         '''
         if self.new_obs is not None:
+            # cached penalty point posteriors are stale once the models change
+            self.pp_cache = None
             for i in update_set:
-                i = int(i)
-                # fit new model
-                self.model[i].fit_model(self.X[i], self.Y[i], previous_hyperparams=self.gp_hyperparams[i])
-                # we also update our estimate of the lipschitz constant, since we have a new model
-                # define the grid over which we will calculate gradients
-                grid = torch.tensor(self.lipschitz_grid, requires_grad = True).double()
-                # we only do this if we are in asynchronous setting, otherwise this should behave as normal UCB algorithm
-                if self.estimate_lipschitz == True:
-                    # calculate mean of the GP
-                    mean, _ = self.model[i].posterior(grid)
-                    # calculate the gradient of the mean
-                    external_grad = torch.ones(self.num_of_grad_points)
-                    mean.backward(gradient = external_grad)
-                    mu_grads = grid.grad
-                    # find the norm of all the mean gradients
-                    mu_norm = torch.norm(mu_grads, dim = 1)
-                    # choose the largest one as our estimate
-                    self.lipschitz_constant[i] = max(mu_norm).item()
+                self.update_single_model(int(i))
+
+    def gp_training_set(self, i):
+        '''
+        Returns the training data of the model of fidelity i. Once there are more than max_gp_points observations, the
+        model is only fitted on the most recent max_gp_points // 2 of them and the best of the older ones, which caps
+        the size of the cholesky factorisation behind every posterior call.
+        '''
+        num_of_obs = len(self.X[i])
+        if (self.max_gp_points is None) or (num_of_obs <= self.max_gp_points):
+            return self.X[i], self.Y[i]
+        # observations are appended in time order, so the most recent ones are at the end
+        num_of_recent = self.max_gp_points // 2
+        num_of_older = num_of_obs - num_of_recent
+        Y = np.asarray(self.Y[i], dtype = np.float64).reshape(-1)
+        best_older = np.argsort(Y[:num_of_older])[num_of_older - (self.max_gp_points - num_of_recent):]
+        keep_idx = np.concatenate((np.sort(best_older), np.arange(num_of_older, num_of_obs)))
+        return np.asarray(self.X[i])[keep_idx, :], Y[keep_idx]
+
+    def update_single_model(self, i):
+        '''
+        This function updates the GP model of fidelity i, and its estimate of the lipschitz constant. The gradients
+        of the mean are taken on the af_dtype copy of the model, so the constant is only estimated in that precision.
+        '''
+        # fit new model
+        train_x, train_y = self.gp_training_set(i)
+        self.model[i].fit_model(train_x, train_y, previous_hyperparams=self.gp_hyperparams[i])
+        # we also update our estimate of the lipschitz constant, since we have a new model
+        # define the grid over which we will calculate gradients
+        grid = self.lipschitz_grid_t.clone().requires_grad_(True)
+        # we only do this if we are in asynchronous setting, otherwise this should behave as normal UCB algorithm
+        if self.estimate_lipschitz == True:
+            # calculate mean of the GP
+            mean, _ = self.model[i].posterior(grid, dtype = self.af_dtype, device = self.device)
+            # calculate the gradient of the mean
+            external_grad = torch.ones(self.num_of_grad_points, device = self.device)
+            mean.backward(gradient = external_grad)
+            mu_grads = grid.grad
+            # find the norm of all the mean gradients
+            mu_norm = torch.norm(mu_grads, dim = 1)
+            # choose the largest one as our estimate
+            self.lipschitz_constant[i] = mu_norm.max().item()
     
     def calculate_local_lipschitz(self, pen_point, fid):
         # if there is no model yet, use the prior
@@ -374,37 +526,58 @@ class mfLiveBatch():
         else:
             return self.lipschitz_constant[fid]
 
-        with torch.no_grad():
-            # first center grid around pen_point
-            grid = torch.tensor(self.lipschitz_grid)
-            # now scale the grid by the lengthscales
-            if self.X[fid] != []:
-                hypers = self.model[fid].current_hyperparams()
-            else:
-                hypers = self.gp_hyperparams[fid]
-            
-            lengthscale = hypers[1]
-            # multiply grid by lengthscales and center
-            grid = (grid - grid[0]) * lengthscale + pen_point
-            # clamp grid in the correct bounds
-            bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
-            for j, (lb, ub) in enumerate(zip(*bounds)):
-                grid.data[..., j].clamp_(lb, ub)
+        # scale the grid by the lengthscales of the model
+        hypers = self.model[fid].current_hyperparams()
+        lengthscale = hypers[1].numpy()
+        # center grid around pen_point and keep it within the bounds
+        grid = prepare_lipschitz_grid(self.lipschitz_grid, pen_point, lengthscale)
 
         # finally estimate lipschitz constant
-        grid = grid.clone().detach().double().requires_grad_(True)
-        # calculate mean of the GP
-        mean, _ = self.model[fid].posterior(grid)
+        grid = torch.from_numpy(grid).requires_grad_(True)
+        # calculate mean of the GP, on the af_dtype copy of the model
+        mean, _ = self.model[fid].posterior(grid, dtype = self.af_dtype, device = self.device)
         # calculate the gradient of the mean
-        external_grad = torch.ones(self.num_of_grad_points)
+        external_grad = torch.ones(self.num_of_grad_points, device = self.device)
         mean.backward(gradient = external_grad)
         mu_grads = grid.grad
         # find the norm of all the mean gradients
         mu_norm = torch.norm(mu_grads, dim = 1)
         # choose the largest one as our estimate
-        lipschitz_constant = max(mu_norm).item()
+        lipschitz_constant = mu_norm.max().item()
         return lipschitz_constant
 
+    def calculate_local_lipschitz_batch(self, pen_points, fid):
+        '''
+        Estimates the local lipschitz constants of several penalty points of the same fidelity,
+        using a single posterior and backward pass over the stacked grids. As in update_single_model, the gradients
+        are taken on the af_dtype copy of the model.
+        '''
+        num_of_points = pen_points.shape[0]
+        # if there is no model yet, use the prior
+        if self.X[fid] != []:
+            pass
+        else:
+            return [self.lipschitz_constant[fid] for _ in range(num_of_points)]
+
+        # scale the grid by the lengthscales of the model
+        hypers = self.model[fid].current_hyperparams()
+        lengthscale = hypers[1].numpy()
+        # center one grid around each penalty point, giving shape (B, G, d)
+        grids = prepare_lipschitz_grid(self.lipschitz_grid, pen_points[:, None, :], lengthscale)
+        grids = grids.reshape(-1, self.dim)
+
+        # finally estimate lipschitz constants
+        grids = torch.from_numpy(grids).requires_grad_(True)
+        # calculate mean of the GP
+        mean, _ = self.model[fid].posterior(grids, dtype = self.af_dtype, device = self.device)
+        # calculate the gradient of the mean
+        mean.sum().backward()
+        mu_grads = grids.grad.reshape(num_of_points, self.num_of_grad_points, self.dim)
+        # find the norm of all the mean gradients and choose the largest one for each point
+        mu_norm = torch.norm(mu_grads, dim = 2)
+        lipschitz_constants = mu_norm.max(dim = 1).values
+        return lipschitz_constants.tolist()
+
     def update_model_bias(self, update_set):
         '''
         This function updates the GP model for the biases
@@ -417,68 +590,193 @@ class mfLiveBatch():
                 hypers = ((self.bias_list[i] * self.bias_constant / self.beta[i])**2, hypers_function[1], 1e-3, 0)
                 self.bias_model[i].fit_model(self.bias_X[i], self.bias_Y[i], previous_hyperparams=hypers)
 
+    def update_penalty_cache(self):
+        '''
+        Caches the posterior at the penalty points of the current batch, grouped by fidelity, together with the
+        prior tensors used by build_af. None of these change while the acquisition function is optimised. The
+        posterior is taken in float64, while the lipschitz constants were estimated on the af_dtype model copy.
+        '''
+        # pre-tensorize the prior of the model of every fidelity, and pre-compute the prior ucb terms
+        # of the model and the bias model, as beta and the bias constant are fixed during the optimisation
+        self.prior_tensors = []
+        self.prior_ucb = []
+        self.prior_ucb_bias = []
+        for i in range(self.num_of_fidelities):
+            hypers = self.gp_hyperparams[i]
+            mean_constant = hypers[3]
+            constant = hypers[0]
+            self.prior_tensors.append((torch.tensor(mean_constant), torch.tensor(constant)))
+            self.prior_ucb.append(float(mean_constant + self.beta[i] * constant))
+            # the bias prior has zero mean and standard deviation bias_list[i] * bias_constant / beta[i]
+            self.prior_ucb_bias.append(float(self.bias_list[i] * self.bias_constant))
+
+        self.pp_cache = {}
+        batch_fids = self.current_batch_fids.reshape(-1).astype(int)
+        lipschitz_batch = np.array(self.lipschitz_batch_list, dtype = float)
+        with torch.no_grad():
+            for fidelity in np.unique(batch_fids):
+                fidelity = int(fidelity)
+                fid_idx = np.where(batch_fids == fidelity)[0]
+                # stack the penalty points of this fidelity as a (B, d) tensor
+                penalty_points = torch.from_numpy(self.current_batch[fid_idx, :]).to(self.device)
+                lipschitz = torch.from_numpy(lipschitz_batch[fid_idx]).to(self.device)
+                # calculate mean and variance of model at the penalty points, in float64 as they end up in the
+                # penaliser denominators of the L-BFGS-B objective, there are only a handful of them
+                if self.X[fidelity] != []:
+                    mean_pp, std_pp = self.model[fidelity].posterior_cached(penalty_points.cpu())
+                    mean_pp, std_pp = mean_pp.to(self.device), std_pp.to(self.device)
+                else:
+                    mean_pp, std_pp = self.prior_tensors[fidelity]
+                self.pp_cache[fidelity] = (penalty_points, lipschitz, mean_pp, std_pp)
+
+    def posterior(self, model, X):
+        '''
+        Returns the posterior of model at X with the precision of X. Float32 inputs are only used to screen the sobol
+        points, anything else goes through the float64 cached posterior so L-BFGS-B sees a smooth objective.
+        '''
+        if X.dtype == torch.float32:
+            return model.posterior(X, dtype = torch.float32, device = X.device)
+        return model.posterior_cached(X)
+
     def build_af(self, X):
         '''
         This takes input locations, X, and returns the value of the acquisition function
         '''
-        # check the batch of points being evaluated
-        batch = self.current_batch.copy()
-        batch_fids = self.current_batch_fids.copy()
-        # initialize ucb
+        # check the cached posterior at the batch of points being evaluated and the prior tensors
+        if self.pp_cache is None:
+            self.update_penalty_cache()
+        # initialize ucb, on the same device and with the same precision as X
         ucb_shape = (self.num_of_fidelities, X.shape[0])
-        ucb = torch.zeros(size = ucb_shape)
+        ucb = torch.zeros(size = ucb_shape, dtype = X.dtype, device = X.device)
         # for every fidelity
         for i in range(self.num_of_fidelities):
             # check if we should use trained model or simply the prior
             if self.X[i] != []:
-                mean, std = self.model[i].posterior(X)
+                mean, std = self.posterior(self.model[i], X)
+                ucb_model = mean + self.beta[i] * std
             else:
-                hypers = self.gp_hyperparams[i]
-                mean_constant = hypers[3]
-                constant = hypers[0]
-                mean, std = torch.tensor(mean_constant), torch.tensor(constant)
+                ucb_model = self.prior_ucb[i]
             # calculate bias upper confidence bound
             if self.bias_X[i] != []:
-                mean_bias, std_bias = self.bias_model[i].posterior(X)
+                mean_bias, std_bias = self.posterior(self.bias_model[i], X)
+                ucb_bias = mean_bias + self.beta[i] * std_bias
             else:
-                mean_bias, std_bias = torch.tensor(0), torch.tensor(self.bias_list[i] * self.bias_constant) / self.beta[i]
-            ucb_bias = mean_bias + self.beta[i] * std_bias
+                ucb_bias = self.prior_ucb_bias[i]
             # calculate total upper confidence bound
-            ucb[i, :] = mean + self.beta[i] * std + ucb_bias
+            ucb[i, :] = ucb_model + ucb_bias
         # apply softmax transform if necessary
         if self.soft_plus_transform:
             ucb = torch.log(1 + torch.exp(ucb))
-        # penalize acquisition function, loop through batch of evaluations
-        for i, penalty_point_fidelity in enumerate(zip(batch, batch_fids)):
-            penalty_point = penalty_point_fidelity[0].reshape(1, -1)
-            fidelity = int(penalty_point_fidelity[1])
-            # re-define penalty point as tensor
-            penalty_point = torch.tensor(penalty_point)
-            # calculate mean and variance of model at penalty point
-            if self.X[fidelity] != []:
-                mean_pp, std_pp = self.model[fidelity].posterior(penalty_point)
-            else:
-                hypers = self.gp_hyperparams[fidelity]
-                mean_constant = hypers[3]
-                constant = hypers[0]
-                mean_pp, std_pp = torch.tensor(mean_constant), torch.tensor(constant)
+        # penalize acquisition function, all penalty points of a fidelity at once
+        # penaliser of each fidelity, built out-of-place and applied once at the end
+        pen_mult = [torch.ones(X.shape[0], dtype = X.dtype, device = X.device) for _ in range(self.num_of_fidelities)]
+        for fidelity, (penalty_points, lipschitz, mean_pp, std_pp) in self.pp_cache.items():
+            # the cache is built in float64 on self.device, X may differ (e.g. the af_dtype sobol screen, grid search)
+            penalty_points, lipschitz = penalty_points.to(X), lipschitz.to(X)
+            mean_pp, std_pp = mean_pp.to(X), std_pp.to(X)
             # calculate values of r_j
-            r_j = (self.max_value[fidelity] - mean_pp) / self.lipschitz_batch_list[i]
-            denominator = r_j + self.penalization_gamma * std_pp / self.lipschitz_batch_list[i]
-            # calculate norm between x and penalty point
-            norm = torch.norm(penalty_point - X, dim = 1)
+            r_j = (self.max_value[fidelity] - mean_pp) / lipschitz
+            denominator = r_j + self.penalization_gamma * std_pp / lipschitz
+            # calculate (B, N) norms between x and penalty points
+            norm = torch.cdist(penalty_points, X)
             # define penaliser
-            penaliser = torch.min(norm / denominator, torch.tensor(1))
-            # penalise ucb
-            ucb[fidelity, :] = ucb[fidelity, :].clone() * penaliser
+            penaliser = torch.clamp(norm / denominator[:, None], max = 1)
+            # product matches sequential multiplication by each penaliser
+            pen_mult[fidelity] = penaliser.prod(dim = 0)
+        # penalise ucb
+        ucb = torch.stack([ucb[i, :] * pen_mult[i] for i in range(self.num_of_fidelities)])
         # return acquisition function
         min_ucb, _ = torch.min(ucb, dim = 0)
         return min_ucb
     
+    def select_fidelity(self, new_X, increasing_thresholds = False):
+        '''
+        Chooses the fidelity of new_X: the lowest fidelity whose (beta scaled if increasing_thresholds) posterior
+        standard deviation is above its threshold, or the target fidelity if there is none.
+        '''
+        # standard deviation of every fidelity at new_X, the prior is used if there is no data
+        stds = np.zeros(self.num_of_fidelities)
+        with torch.no_grad():
+            for i in range(1, self.num_of_fidelities):
+                if self.X[i] != []:
+                    _, std = self.model[i].posterior_cached(new_X)
+                    stds[i] = float(std)
+                else:
+                    stds[i] = self.gp_hyperparams[i][0]
+        # check all fidelity thresholds at once
+        if increasing_thresholds:
+            thresholds = np.array(self.beta[:self.num_of_fidelities], dtype = np.float64) * stds
+        else:
+            thresholds = stds
+        above = thresholds[1:] > self.fidelity_thresholds[1:self.num_of_fidelities]
+        # the lowest fidelity is the one with the largest index
+        above_idx = np.flatnonzero(above) + 1
+        if len(above_idx) > 0:
+            new_M_int = int(above_idx[-1])
+        else:
+            new_M_int = 0
+        return np.array(new_M_int).reshape(1, 1)
+
+    def update_fidelity_thresholds(self, new_M_int):
+        '''
+        Counts a new query at fidelity new_M_int and resets the count of the fidelity above it. Once a lower fidelity
+        has been queried more often than its cost threshold in a row, its threshold is doubled and its count reset.
+        '''
+        self.fidelity_count_list[new_M_int] += 1
+        if new_M_int != self.num_of_fidelities - 1:
+            self.fidelity_count_list[new_M_int + 1] = 0
+        
+        if (new_M_int != 0) and (self.fidelity_count_list[new_M_int] > self.cost_thresholds[new_M_int]):
+            self.fidelity_thresholds[new_M_int] *= 2
+            self.fidelity_count_list[new_M_int] = 0
+
+    def fill_batch(self, new_X, num_of_points):
+        '''
+        Returns num_of_points extra queries to fill the remaining batch space. The optimised starts of the last
+        optimise_af call are used first, best first, skipping any start within min_start_distance of a query that has
+        already been chosen. If there are not enough of them, the rest of the batch is filled randomly.
+        '''
+        chosen = new_X.reshape(1, -1)
+        for start in self.optimised_starts:
+            if chosen.shape[0] == num_of_points + 1:
+                break
+            if np.linalg.norm(chosen - start, axis = 1).min() > self.min_start_distance:
+                chosen = np.concatenate((chosen, start.reshape(1, -1)))
+        num_of_random = num_of_points + 1 - chosen.shape[0]
+        return np.concatenate((chosen[1:, :], np.random.uniform(size = (num_of_random, self.dim))))
+
+    def num_of_sobol_points(self):
+        '''
+        Returns the number of sobol points screened for the optimisation starts, num_of_raw_samples if it is set.
+        '''
+        if self.num_of_raw_samples is not None:
+            return self.num_of_raw_samples
+        if self.dim > 5:
+            dim_multiplier = 5
+        else:
+            dim_multiplier = self.dim
+        return 100 * self.num_of_starts * dim_multiplier
+
+    def draw_sobol_starts(self):
+        '''
+        Returns the sobol points used to initialise the acquisition function optimisation. These are sampled
+        from a pool that is only redrawn every sobol_refresh_rate time-steps.
+        '''
+        num_of_points = self.num_of_sobol_points()
+        # redraw the pool if it is stale
+        if (self.sobol_pool is None) or (self.current_time - self.sobol_pool_time >= self.sobol_refresh_rate):
+            self.sobol_pool = self.sobol_gen.draw(2 * num_of_points).double()
+            self.sobol_pool_time = self.current_time
+        # select random rows of the pool
+        idx = torch.randperm(self.sobol_pool.shape[0])[:num_of_points]
+        return self.sobol_pool[idx, :]
+
     def optimise_af(self):
         '''
         This function optimizes the acquisition function, and returns the next query point
         '''
+        # there are no optimised starts unless the gradient based optimisation runs
+        self.optimised_starts = np.empty((0, self.dim))
         # if time is zero, pick point at random, lowest fidelity
         if self.current_time == 0:
             new_X = np.random.uniform(size = self.dim).reshape(1, -1)
@@ -496,128 +794,67 @@ class mfLiveBatch():
                 # choose the best point
                 best_idx = torch.argmax(af)
             # return the best value in the grid
-            best_input = X[best_idx, :].detach()
-            best = best_input.detach().numpy().reshape(1, -1)
-            new_X = best.reshape(1, -1)
+            new_X = X[best_idx, :].detach().cpu().numpy().reshape(1, -1)
             # choose fidelity level for this point
-            for i in reversed(range(self.num_of_fidelities)):
-                # set fidelity
-                new_M = np.array(i).reshape(1, 1)
-                # if we reach target fidelity, break
-                if i == 0:
-                    break
-                # if there is data use posterior, else use prior
-                if self.X[i] != []:
-                    _, std = self.model[i].posterior(new_X)
-                else:
-                    hypers = self.gp_hyperparams[i]
-                    mean_constant = hypers[3]
-                    constant = hypers[0]
-                    _, std = torch.tensor(mean_constant), torch.tensor(constant)
-                
-                # check fidelity thresholds
-                threshold = self.beta[i] * std
-                if threshold > self.fidelity_thresholds[i]:
-                    break
-
-            new_M_int = int(new_M)
-            self.fidelity_count_list[new_M_int] = self.fidelity_count_list[new_M_int] + 1
-            if new_M_int != self.num_of_fidelities - 1:
-                self.fidelity_count_list[new_M_int + 1] = 0
-            
-            if (self.fidelity_count_list[new_M_int] > self.cost_thresholds[new_M_int]) & (new_M_int != 0):
-                # self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] + self.fidelity_thresholds_init[new_M_int] * self.dim
-                self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] * 2
-                self.fidelity_count_list[new_M_int] = 0
+            new_M = self.select_fidelity(new_X, increasing_thresholds = True)
+
+            self.update_fidelity_thresholds(int(new_M))
 
             return new_X, new_M
 
         # optimisation bounds
-        bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
+        bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)]).double()
         # sobol initialization initialization, on 100 * num_of_starts, check for best 10 and optimize from there
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-        if self.dim > 5:
-            dim_multiplier = 5
-        else:
-            dim_multiplier = self.dim
-        X = sobol_gen.draw(100 * self.num_of_starts * dim_multiplier).double()
+        # screen the sobol points in af_dtype on self.device, only the chosen starts are refined in float64
+        X = self.draw_sobol_starts().to(device = self.device, dtype = self.af_dtype)
 
         with torch.no_grad():
             af = self.build_af(X)
-            idx_list = list(range(0, self.num_of_starts * 100 * dim_multiplier))
-            sorted_af_idx = [idx for _, idx in sorted(zip(af, idx_list))]
-            best_idx = sorted_af_idx[-10:]
-
-        # choose best starts for X
-        X = X[best_idx, :]
-        X.requires_grad = True
-        # define optimiser
-        optimiser = torch.optim.Adam([X], lr = 0.01)
-        af = self.build_af(X)
-        
-        # do the optimisation
-        for _ in range(self.num_of_optim_epochs):
-            # set zero grad
-            optimiser.zero_grad()
-            # losses for optimiser
-            losses = -self.build_af(X)
-            loss = losses.sum()
-            loss.backward()
-            # optim step
-            optimiser.step()
-
-            # make sure we are still within the bounds
-            for j, (lb, ub) in enumerate(zip(*bounds)):
-                X.data[..., j].clamp_(lb, ub)
+            # draw the starts with Boltzmann weights on the standardised acquisition values
+            af_std = (af - af.mean()) / (af.std() + 1e-9)
+            # exp overflows for large standardised values on peaked screens, halve the temperature until the weights are finite
+            eta = 1.0
+            weights = torch.exp(eta * af_std)
+            while torch.isinf(weights).any():
+                eta *= 0.5
+                weights = torch.exp(eta * af_std)
+            # only points close to the best value can be drawn, as long as there are enough of them
+            close_to_max = af > 1e-4 * af.max()
+            if close_to_max.sum() >= 10:
+                weights = weights * close_to_max
+            best_idx = torch.multinomial(weights, 10, replacement = False)
+            # the best sobol point is always optimised, replacing the last draw if needed
+            af_argmax = torch.argmax(af)
+            if not (best_idx == af_argmax).any():
+                best_idx[-1] = af_argmax
+
+        # choose best starts for X, the refinement runs on the float64 models
+        X = X[best_idx, :].cpu().double()
+        # optimise all starts jointly with L-BFGS-B, scipy handles the box constraints
+        X, af = gen_candidates_scipy(initial_conditions = X, acquisition_function = self.build_af, \
+            lower_bounds = bounds[0], upper_bounds = bounds[1], options = {'maxiter': self.num_of_optim_epochs})
         
         # find the best start
-        best_start = torch.argmax(-losses)
+        best_start = torch.argmax(af)
+        # keep the other optimised starts, best first, they can fill the rest of the batch
+        start_order = torch.argsort(af, descending = True)
+        self.optimised_starts = X[start_order[1:], :].detach().cpu().numpy()
 
         # corresponding best input
-        best_input = X[best_start, :].detach()
-        best = best_input.detach().numpy().reshape(1, -1)
-        new_X = best.reshape(1, -1)
+        new_X = X[best_start, :].detach().cpu().numpy().reshape(1, -1)
 
         # now choose the corresponding fidelity
-        for i in reversed(range(self.num_of_fidelities)):
-            # set fidelity
-            new_M = np.array(i).reshape(1, 1)
-            # if we reach target fidelity, break
-            if i == 0:
-                break
-            # if there is data use posterior, else use prior
-            if self.X[i] != []:
-                _, std = self.model[i].posterior(new_X)
-            else:
-                hypers = self.gp_hyperparams[i]
-                mean_constant = hypers[3]
-                constant = hypers[0]
-                _, std = torch.tensor(mean_constant), torch.tensor(constant)
-            
-            # check fidelity thresholds
-            if self.increasing_thresholds:
-                threshold = self.beta[i] * std
-            else:
-                threshold = std
-
-            if threshold > self.fidelity_thresholds[i]:
-                break
+        new_M = self.select_fidelity(new_X, increasing_thresholds = self.increasing_thresholds)
         
-        new_M_int = int(new_M)
-        self.fidelity_count_list[new_M_int] = self.fidelity_count_list[new_M_int] + 1
-        if new_M_int != self.num_of_fidelities - 1:
-            self.fidelity_count_list[new_M_int + 1] = 0
-        
-        if (self.fidelity_count_list[new_M_int] > self.cost_thresholds[new_M_int]) & (new_M_int != 0):
-            # self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] + self.fidelity_thresholds_init[new_M_int] * self.dim
-            self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] * 2
-            self.fidelity_count_list[new_M_int] = 0
+        self.update_fidelity_thresholds(int(new_M))
         
         return new_X, new_M
 
 class UCBwILP(mfLiveBatch):
-    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, local_lipschitz = True):
-        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias)
+    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, local_lipschitz = True, \
+        num_of_raw_samples=None, use_gpu=False, max_gp_points=None):
+        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias, \
+            num_of_raw_samples=num_of_raw_samples, use_gpu=use_gpu, max_gp_points=max_gp_points)
         self.num_of_fidelities = 1
         self.local_lipschitz = local_lipschitz
 
@@ -625,12 +862,14 @@ class mfUCB(mfLiveBatch):
     '''
     Class for Multi-Fidelity Upper Confidence Bound Bayesian Optimization model. This is a sequential method that takes advantage of multi-fidelity measurements.
     '''
-    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, increasing_thesholds = False):
-        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias, increasing_thresholds=increasing_thesholds)
+    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, increasing_thesholds = False, \
+        num_of_raw_samples=None, use_gpu=False, max_gp_points=None):
+        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias, increasing_thresholds=increasing_thesholds, \
+            num_of_raw_samples=num_of_raw_samples, use_gpu=use_gpu, max_gp_points=max_gp_points)
         self.query_being_evaluated = False
         # costs thresholds to double the fidelity thresholds
-        self.cost_thresholds = [0] + [self.env.func.expected_costs[i] / self.env.func.expected_costs[i +1] \
-             for i in range(self.num_of_fidelities - 1)]
+        self.cost_thresholds = np.concatenate(([0], \
+            self.expected_costs[:self.num_of_fidelities - 1] / self.expected_costs[1:self.num_of_fidelities]))
 
     def optim_loop(self):
         '''
@@ -638,8 +877,11 @@ class mfUCB(mfLiveBatch):
         '''
         # check if we need to update beta
         if self.fixed_beta == False:
-            beta = float(0.2 * self.dim * np.log(2 * (self.current_time + 1) / (self.env.func.expected_costs[0])))
+            beta = float(0.2 * self.dim * np.log(2 * (self.current_time + 1) / (self.expected_costs[0])))
             self.beta = [beta for _ in range(self.num_of_fidelities)]
+        # beta and bias terms as tensors, fixed while the acquisition function is optimised
+        self.beta_t = torch.tensor(self.beta[:self.num_of_fidelities]).double()
+        self.bias_t = torch.tensor(self.bias_list[:self.num_of_fidelities]).double() * self.bias_constant
 
         # optimise acquisition function if no function is being evaluated
         new_Xs = np.empty((0, self.dim))
@@ -648,21 +890,23 @@ class mfUCB(mfLiveBatch):
         if self.query_being_evaluated is False:
             # obtain new query
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            fidelity = int(new_M)
             # add to batch costs
-            self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
+            self.batch_costs = self.batch_costs + self.fidelity_costs[fidelity]
             # check if our main query is finished evaluating
             self.query_being_evaluated = True
 
-            # now fill the remaining batch space randomly
+            # count how many extra queries fit in the remaining batch space
+            num_of_extra = 0
             while self.batch_costs < self.cost_budget:
-                new_X = np.random.uniform(size = (1, self.dim))
-                # add to new_Xs and new_Ms
-                new_Xs = np.concatenate((new_Xs, new_X))
-                new_Ms = np.concatenate((new_Ms, new_M))
+                num_of_extra = num_of_extra + 1
                 # add to batch costs
-                self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
+                self.batch_costs = self.batch_costs + self.fidelity_costs[fidelity]
+            # now fill the remaining batch space with the other optimised starts, preallocating new_Xs and new_Ms
+            new_Xs = np.empty((num_of_extra + 1, self.dim))
+            new_Xs[0, :] = new_X
+            new_Xs[1:, :] = self.fill_batch(new_X, num_of_extra)
+            new_Ms = np.full((num_of_extra + 1, 1), fidelity, dtype = np.float64)
 
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
@@ -674,7 +918,7 @@ class mfUCB(mfLiveBatch):
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 # if fidelity is not the lowest, check bias assumption
@@ -688,10 +932,10 @@ class mfUCB(mfLiveBatch):
                     if (diff > self.bias_constant) & (self.update_max_bias):
                         self.bias_constant = 1.2 * diff
                 # take away batch cost
-                self.batch_costs = self.batch_costs - self.env.func.fidelity_costs[fid]
+                self.batch_costs = self.batch_costs - self.fidelity_costs[fid]
 
             # check which model need to be updated according to the fidelities
-            update_set = set(obtain_fidelities.reshape(-1))
+            update_set = np.unique(obtain_fidelities.astype(np.int64))
             self.update_model(update_set)
             # this means we are no longer evaluating a query
             self.query_being_evaluated = False
@@ -752,32 +996,34 @@ class mfUCB(mfLiveBatch):
         '''
         This takes input locations, X, and returns the value of the acquisition function
         '''
-        # initialize ucb
-        ucb_shape = (self.num_of_fidelities, X.shape[0])
-        ucb = torch.zeros(size = ucb_shape)
-        # for every fidelity
+        # posterior of every fidelity, stacked into (M, N) tensors
+        means = []
+        stds = []
         for i in range(self.num_of_fidelities):
             if self.X[i] != []:
-                # if we have no data return prior
-                if self.model[i].train_x == None:
-                    print('x')
-                mean, std = self.model[i].posterior(X)
+                if X.dtype == torch.float32:
+                    # single precision screening pass
+                    mean, std = self.model[i].posterior(X, dtype = torch.float32)
+                else:
+                    # the cholesky factor of the training data is cached until the model is refitted
+                    mean, std = self.model[i].posterior_cached(X)
             else:
                 hypers = self.gp_hyperparams[i]
                 mean_constant = hypers[3]
                 constant = hypers[0]
-                mean, std = torch.tensor(mean_constant), torch.tensor(constant)
-            # calculate upper confidence bound
-            ucb[i, :] = mean + self.beta[i] * std + self.bias_list[i] * self.bias_constant
-        
+                mean = torch.full((X.shape[0],), float(mean_constant), dtype = X.dtype, device = X.device)
+                std = torch.full((X.shape[0],), float(constant), dtype = X.dtype, device = X.device)
+            means.append(mean)
+            stds.append(std)
         # return acquisition function
-        min_ucb, _ = torch.min(ucb, dim = 0)
-        return min_ucb
+        return min_ucb(torch.stack(means), torch.stack(stds), self.beta_t.to(X), self.bias_t.to(X))
 
     def optimise_af(self):
         '''
         This function optimizes the acquisition function, and returns the next query point
         '''
+        # there are no optimised starts unless the gradient based optimisation runs
+        self.optimised_starts = np.empty((0, self.dim))
         # if time is zero, pick point at random, lowest fidelity
         if self.current_time == 0:
             new_X = np.random.uniform(size = self.dim).reshape(1, -1)
@@ -795,123 +1041,46 @@ class mfUCB(mfLiveBatch):
                 # choose the best point
                 best_idx = torch.argmax(af)
             # return the best value in the grid
-            best_input = X[best_idx, :].detach()
-            best = best_input.detach().numpy().reshape(1, -1)
-            new_X = best.reshape(1, -1)
+            new_X = X[best_idx, :].detach().cpu().numpy().reshape(1, -1)
             # choose fidelity level for this point
-            for i in reversed(range(self.num_of_fidelities)):
-                # set fidelity
-                new_M = np.array(i).reshape(1, 1)
-                # if we reach target fidelity, break
-                if i == 0:
-                    break
-                # if there is data use posterior, else use prior
-                if self.X[i] != []:
-                    _, std = self.model[i].posterior(new_X)
-                else:
-                    hypers = self.gp_hyperparams[i]
-                    mean_constant = hypers[3]
-                    constant = hypers[0]
-                    _, std = torch.tensor(mean_constant), torch.tensor(constant)
-                
-                # check fidelity thresholds
-                threshold = self.beta[i] * std
-                if threshold > self.fidelity_thresholds[i]:
-                    break
-
-            new_M_int = int(new_M)
-            self.fidelity_count_list[new_M_int] = self.fidelity_count_list[new_M_int] + 1
-            if new_M_int != self.num_of_fidelities - 1:
-                self.fidelity_count_list[new_M_int + 1] = 0
-            
-            if (self.fidelity_count_list[new_M_int] > self.cost_thresholds[new_M_int]) & (new_M_int != 0):
-                # self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] + self.fidelity_thresholds_init[new_M_int] * self.dim
-                self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] * 2
-                self.fidelity_count_list[new_M_int] = 0
+            new_M = self.select_fidelity(new_X, increasing_thresholds = True)
+
+            self.update_fidelity_thresholds(int(new_M))
 
             return new_X, new_M
 
         # optimisation bounds
-        bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
+        bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)]).double()
         
         # sobol initialization initialization, on 100 * num_of_starts, check for best 10 and optimize from there
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
+        # the scrambled engine is created once in __init__ and keeps advancing along its sequence
 
-        if self.dim > 5:
-            dim_multiplier = 5
-        else:
-            dim_multiplier = self.dim
-
-        X = sobol_gen.draw(100 * self.num_of_starts * dim_multiplier).double()
+        # screen the sobol points in float32, only the best starts are refined in float64
+        X = self.sobol_gen.draw(self.num_of_sobol_points()).to(self.device)
         with torch.no_grad():
             af = self.build_af(X)
-            idx_list = list(range(0, self.num_of_starts * 100 * dim_multiplier))
-            sorted_af_idx = [idx for _, idx in sorted(zip(af, idx_list))]
-            best_idx = sorted_af_idx[-10:]
-
-        # choose best starts for X
-        X = X[best_idx, :]
-        X.requires_grad = True
-        # define optimiser
-        optimiser = torch.optim.Adam([X], lr = 0.01)
-        af = self.build_af(X)
-        
-        # do the optimisation
-        for _ in range(self.num_of_optim_epochs):
-            # set zero grad
-            optimiser.zero_grad()
-            # losses for optimiser
-            losses = -self.build_af(X)
-            loss = losses.sum()
-            loss.backward()
-            # optim step
-            optimiser.step()
-
-            # make sure we are still within the bounds
-            for j, (lb, ub) in enumerate(zip(*bounds)):
-                X.data[..., j].clamp_(lb, ub)
+            # choose the 10 best starts
+            _, best_idx = torch.topk(af, 10)
+
+        # choose best starts for X, the refinement runs on the float64 models on the cpu
+        X = X[best_idx, :].cpu().double()
+        # optimise all starts jointly with L-BFGS-B, scipy handles the box constraints
+        X, af = gen_candidates_scipy(initial_conditions = X, acquisition_function = self.build_af, \
+            lower_bounds = bounds[0], upper_bounds = bounds[1], options = {'maxiter': self.num_of_optim_epochs})
         
         # find the best start
-        best_start = torch.argmax(-losses)
+        best_start = torch.argmax(af)
+        # keep the other optimised starts, best first, they can fill the rest of the batch
+        start_order = torch.argsort(af, descending = True)
+        self.optimised_starts = X[start_order[1:], :].detach().cpu().numpy()
 
         # corresponding best input
-        best_input = X[best_start, :].detach()
-        best = best_input.detach().numpy().reshape(1, -1)
-        new_X = best.reshape(1, -1)
+        new_X = X[best_start, :].detach().cpu().numpy().reshape(1, -1)
 
         # now choose the corresponding fidelity
-        for i in reversed(range(self.num_of_fidelities)):
-            # set fidelity
-            new_M = np.array(i).reshape(1, 1)
-            # if we reach target fidelity, break
-            if i == 0:
-                break
-            # if there is data use posterior, else use prior
-            if self.X[i] != []:
-                _, std = self.model[i].posterior(new_X)
-            else:
-                hypers = self.gp_hyperparams[i]
-                mean_constant = hypers[3]
-                constant = hypers[0]
-                _, std = torch.tensor(mean_constant), torch.tensor(constant)
-            # check fidelity thresholds
-            if self.increasing_thresholds:
-                threshold = self.beta[i] * std
-            else:
-                threshold = std
-            
-            if threshold > self.fidelity_thresholds[i]:
-                break
+        new_M = self.select_fidelity(new_X, increasing_thresholds = self.increasing_thresholds)
         
-        new_M_int = int(new_M)
-        self.fidelity_count_list[new_M_int] = self.fidelity_count_list[new_M_int] + 1
-        if new_M_int != self.num_of_fidelities - 1:
-            self.fidelity_count_list[new_M_int + 1] = 0
-        
-        if (self.fidelity_count_list[new_M_int] > self.cost_thresholds[new_M_int]) & (new_M_int != 0):
-            # self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] + self.fidelity_thresholds_init[new_M_int]
-            self.fidelity_thresholds[new_M_int] = self.fidelity_thresholds[new_M_int] * 2
-            self.fidelity_count_list[new_M_int] = 0
+        self.update_fidelity_thresholds(int(new_M))
         
         return new_X, new_M
 
@@ -919,12 +1088,14 @@ class mfUCBPlus(mfLiveBatch):
     '''
     Class for Multi-Fidelity Upper Confidence Bound Bayesian Optimization model. This is a sequential method that takes advantage of multi-fidelity measurements.
     '''
-    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0):
-        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias)
+    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, \
+        num_of_raw_samples=None, use_gpu=False, max_gp_points=None):
+        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias, \
+            num_of_raw_samples=num_of_raw_samples, use_gpu=use_gpu, max_gp_points=max_gp_points)
         self.query_being_evaluated = False
         # costs thresholds to double the fidelity thresholds
-        self.cost_thresholds = [0] + [self.env.func.expected_costs[i] / self.env.func.expected_costs[i + 1] \
-             for i in range(self.num_of_fidelities - 1)]
+        self.cost_thresholds = np.concatenate(([0], \
+            self.expected_costs[:self.num_of_fidelities - 1] / self.expected_costs[1:self.num_of_fidelities]))
 
     def optim_loop(self):
         '''
@@ -941,21 +1112,23 @@ class mfUCBPlus(mfLiveBatch):
         if self.query_being_evaluated is False:
             # obtain new query
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            fidelity = int(new_M)
             # add to batch costs
-            self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
+            self.batch_costs = self.batch_costs + self.fidelity_costs[fidelity]
             # check if our main query is finished evaluating
             self.query_being_evaluated = True
 
-            # now fill the remaining batch space randomly
+            # count how many extra queries fit in the remaining batch space
+            num_of_extra = 0
             while self.batch_costs < self.cost_budget:
-                new_X = np.random.uniform(size = (1, self.dim))
-                # add to new_Xs and new_Ms
-                new_Xs = np.concatenate((new_Xs, new_X))
-                new_Ms = np.concatenate((new_Ms, new_M))
+                num_of_extra = num_of_extra + 1
                 # add to batch costs
-                self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
+                self.batch_costs = self.batch_costs + self.fidelity_costs[fidelity]
+            # now fill the remaining batch space with the other optimised starts, preallocating new_Xs and new_Ms
+            new_Xs = np.empty((num_of_extra + 1, self.dim))
+            new_Xs[0, :] = new_X
+            new_Xs[1:, :] = self.fill_batch(new_X, num_of_extra)
+            new_Ms = np.full((num_of_extra + 1, 1), fidelity, dtype = np.float64)
 
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
@@ -968,7 +1141,7 @@ class mfUCBPlus(mfLiveBatch):
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 if fid != self.num_of_fidelities - 1:
@@ -980,29 +1153,32 @@ class mfUCBPlus(mfLiveBatch):
                     diff = float(f_high_fid_obs - f_low_fid_pred)
                     if diff > self.bias_constant:
                         self.bias_constant = 1.2 * diff
-                    # if we observe highest fidelity, obtain bias observations
-                    if fid == 0:
-                        for lower_fid in range(1, self.num_of_fidelities):
-                            # check the mean of each prediction
-                            f_low_fid_pred, _ = self.model[lower_fid].posterior(obtain_query[i, :].reshape(1, -1))
-                            f_low_fid_pred = f_low_fid_pred.detach().numpy()
-                            # calculate difference
-                            diff = f_high_fid_obs - f_low_fid_pred
-                            # append corresponding bias observations
-                            self.bias_X[lower_fid].append(list(obtain_query[i, :].reshape(-1)))
-                            self.bias_Y[lower_fid].append(diff)
-                            bias_updates.append(lower_fid)
-                            if lower_fid == 2:
-                                print('wut')
                 # redefine new maximum value
                 self.max_value[fid] = float(max(self.max_value[fid], float(self.new_obs[i])))
                 # remove cost
-                self.batch_costs = self.batch_costs - self.env.func.fidelity_costs[fid]
+                self.batch_costs = self.batch_costs - self.fidelity_costs[fid]
                 # query no longer being evaluated
                 self.query_being_evaluated = False
 
+            # if we observe highest fidelity, obtain bias observations, predicting all of them at once for each lower fidelity
+            high_fid_idx = np.where(obtain_fidelities.reshape(-1) == 0)[0]
+            if (high_fid_idx.shape[0] > 0) & (self.num_of_fidelities > 1):
+                high_fid_X = obtain_query[high_fid_idx, :]
+                f_high_fid_obs = np.asarray(self.new_obs).reshape(-1)[high_fid_idx]
+                for lower_fid in range(1, self.num_of_fidelities):
+                    # check the mean of each prediction
+                    with torch.no_grad():
+                        f_low_fid_pred, _ = self.model[lower_fid].posterior(high_fid_X)
+                    f_low_fid_pred = f_low_fid_pred.numpy().reshape(-1)
+                    # calculate difference
+                    diff = f_high_fid_obs - f_low_fid_pred
+                    # append corresponding bias observations
+                    self.bias_X[lower_fid].extend(high_fid_X.copy())
+                    self.bias_Y[lower_fid].extend(diff)
+                    bias_updates.append(lower_fid)
+
             # check which model need to be updated according to the fidelities
-            update_set = set(obtain_fidelities.reshape(-1))
+            update_set = np.unique(obtain_fidelities.astype(np.int64))
             bias_update_set = set(bias_updates)
             self.update_model(update_set)
             self.update_model_bias(bias_update_set)
@@ -1020,16 +1196,12 @@ class mfUCBPlus(mfLiveBatch):
         '''
         This takes input locations, X, and returns the value of the acquisition function
         '''
-        # initialize ucb
-        ucb_shape = (self.num_of_fidelities, X.shape[0])
-        ucb = torch.zeros(size = ucb_shape)
+        # ucb of every fidelity, stacked out-of-place instead of written into a zeros tensor
+        ucb = []
         # for every fidelity
         for i in range(self.num_of_fidelities):
             if self.X[i] != []:
-                # if we have no data return prior
-                if self.model[i].train_x == None:
-                    print('x')
-                mean, std = self.model[i].posterior(X)
+                mean, std = self.posterior(self.model[i], X)
             else:
                 hypers = self.gp_hyperparams[i]
                 mean_constant = hypers[3]
@@ -1037,20 +1209,23 @@ class mfUCBPlus(mfLiveBatch):
                 mean, std = torch.tensor(mean_constant), torch.tensor(constant)
             # calculate bias upper confidence bound
             if self.bias_X[i] != []:
-                mean_bias, std_bias = self.bias_model[i].posterior(X)
+                mean_bias, std_bias = self.posterior(self.bias_model[i], X)
             else:
                 mean_bias, std_bias = torch.tensor(0), torch.tensor(self.bias_list[i] * self.bias_constant) / self.beta[i]
             ucb_bias = mean_bias + self.beta[i] * std_bias
-            # calculate upper confidence bound
-            ucb[i, :] = mean + self.beta[i] * std + ucb_bias
+            # calculate upper confidence bound, the prior rows are cast to the dtype and device of X so they stack
+            ucb.append(torch.broadcast_to(mean + self.beta[i] * std + ucb_bias, (X.shape[0],)).to(X))
+        ucb = torch.stack(ucb)
         
         # return acquisition function
         min_ucb, _ = torch.min(ucb, dim = 0)
         return min_ucb
 
 class simpleUCB(mfUCB):
-    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0):
-        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias)
+    def __init__(self, env, beta=None, fidelity_thresholds=None, lipschitz_constant=1, num_of_starts=75, num_of_optim_epochs=25, hp_update_frequency=None, budget=10, cost_budget=4, initial_bias=0, \
+        num_of_raw_samples=None, use_gpu=False, max_gp_points=None):
+        super().__init__(env, beta, fidelity_thresholds, lipschitz_constant, num_of_starts, num_of_optim_epochs, hp_update_frequency, budget, cost_budget, initial_bias, \
+            num_of_raw_samples=num_of_raw_samples, use_gpu=use_gpu, max_gp_points=max_gp_points)
         self.num_of_fidelities = 1
 
 class MultiTaskUCBwILP():
@@ -1067,13 +1242,15 @@ class MultiTaskUCBwILP():
             local_lipschitz = True, 
             fidelity_thresholds = None, 
             increasing_thresholds = False,
-            fidelity_choice = 'variance_thresholds'):
+            fidelity_choice = 'variance_thresholds',
+            use_gpu = False):
         '''
         Takes as inputs:
         env - optimization environment
         num_of_starts - number of multi-starts for optimizing the acquisition function, default is 75
         num_of_optim_epochs - number of epochs for optimizing the acquisition function, default is 150
         hp_update_frequency - how ofter should GP hyper-parameters be re-evaluated, default is None
+        use_gpu - if True and cuda is available, the information gain integrals are evaluated on the gpu, default is False
         '''
         # initialise the environment
         self.env = env
@@ -1099,6 +1276,8 @@ class MultiTaskUCBwILP():
             self.num_of_integration_steps = 250
             self.num_of_fantasies = 100
             self.num_stability = 1e-30
+        # check the information gain tensors for nans and infs, only needed for debugging
+        self.debug_nan_checks = False
 
         # LCM parameters
         # number of latent functions
@@ -1127,15 +1306,33 @@ class MultiTaskUCBwILP():
         self.max_value = -10
         self.lipschitz_constant = 1
         self.penalization_gamma = 1
+        # penalty points of the current batch and their penaliser denominators, rebuilt whenever the batch changes
+        self.pp_cache = None
+        # fidelity index vectors of the acquisition function, keyed by (fidelity, batch size)
+        self.fidelity_vector_cache = {}
         # initialize grid to select lipschitz constant
         self.estimate_lipschitz = True
         self.num_of_grad_points = 50 * self.dim
-        self.lipschitz_grid = sobol_seq.i4_sobol_generate(self.dim, self.num_of_grad_points)
+        # unscrambled sobol grid, skipping the origin so the first point is the centre of the unit box
+        lipschitz_sobol = torch.quasirandom.SobolEngine(self.dim, scramble = False)
+        lipschitz_sobol.fast_forward(1)
+        self.lipschitz_grid = lipschitz_sobol.draw(self.num_of_grad_points).double().numpy()
+        # the grid is fixed for the whole run, so keep a tensor view of it as well
+        self.lipschitz_grid_t = torch.from_numpy(self.lipschitz_grid).double()
+        # bounds of the unit box domain, used for clamping
+        self.bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)]).double()
         # acquisition function optimization parameters
         self.num_of_starts = num_of_starts
         self.num_of_optim_epochs = num_of_optim_epochs
         self.grid_search = self.env.func.grid_search
         self.grid_to_search = None
+        # scrambled sobol engine for the optimisation starts and the max-value samples, reused across time-steps
+        self.sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
+        # device of the information gain integrals, the model is always fitted on the cpu
+        if use_gpu and torch.cuda.is_available():
+            self.device = torch.device('cuda:0')
+        else:
+            self.device = torch.device('cpu')
         # hp hyperparameters update frequency
         self.hp_update_frequency = hp_update_frequency
         self.last_n_obs = 0
@@ -1153,7 +1350,7 @@ class MultiTaskUCBwILP():
     
     def initialise_stuff(self):
         # list of queries
-        self.queried_batch = [[]] * self.num_of_fidelities
+        self.queried_batch = [[] for _ in range(self.num_of_fidelities)]
         # list of queries and observations
         self.X = [[] for _ in range(self.num_of_fidelities)]
         self.Y = [[] for _ in range(self.num_of_fidelities)]
@@ -1176,7 +1373,7 @@ class MultiTaskUCBwILP():
         mean_constant: float, value of prior mean
         constraints: boolean, if True, we will apply constraints from paper based on the given hyperparameters
         '''
-        if constant == None:
+        if constant is None:
             self.constant = 0.6
             self.length_scale = torch.tensor([0.15 for _ in range(self.dim)])
             self.noise = 1e-4
@@ -1231,12 +1428,20 @@ class MultiTaskUCBwILP():
         # optimise acquisition function to obtain new queries until batch is full
         new_Xs = np.empty((0, self.dim))
         new_Ms = np.empty((0, 1))
+        new_X_list = []
+        new_M_list = []
         
         self.lipschitz_batch_list = []
         # obtain current batch
         self.current_batch = self.env.query_list.copy()
         self.current_batch_fids = self.env.fidelities_list.copy()
+        self.update_batch_tensors()
         if self.local_lipschitz:
+            # the lengthscale used to scale the lipschitz grid is fixed during the loop
+            if self.X[-1] != []:
+                self.lipschitz_lengthscale = self.model.model.covar_module_0.lengthscale.detach()
+            else:
+                self.lipschitz_lengthscale = self.length_scale
             for i, penalty_point_fidelity in enumerate(zip(self.current_batch, self.current_batch_fids)):
                 penalty_point = penalty_point_fidelity[0].reshape(1, -1)
                 fidelity = int(penalty_point_fidelity[1]) # not needed
@@ -1252,6 +1457,8 @@ class MultiTaskUCBwILP():
             for i, penalty_point_fidelity in enumerate(zip(batch, batch_fids)):
                 fidelity = int(penalty_point_fidelity[1]) # not really needed
                 self.lipschitz_batch_list.append(self.lipschitz_constant)
+        # cache the posterior at the penalty points
+        self.update_penalty_cache()
         
         # generate maximum samples if we are going to use information based fidelity selection
         if (self.batch_costs < self.cost_budget) & (self.fidelity_choice == 'information_based') & (self.current_time > 0):
@@ -1261,22 +1468,25 @@ class MultiTaskUCBwILP():
         while self.batch_costs < self.cost_budget:
 #            self.lipshitz_batch_list = []
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            new_X_list.append(new_X)
+            new_M_list.append(new_M)
             # add new_X and new_M to current batch
             self.current_batch = np.concatenate((self.current_batch, new_X))
             self.current_batch_fids = np.concatenate((self.current_batch_fids, new_M))
+            self.update_batch_tensors()
             # update batch costs
             self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
             # if loop is not going to break, add new lipschitz constant
             if self.batch_costs < self.cost_budget:
-                # new_M and new_X define the penalty point
-                fidelity = int(new_M) # not needed
-                penalty_point = torch.tensor(new_X)
-                # calculate local lipschitz constant
-                local_lip_constant = self.calculate_local_lipschitz(penalty_point)
+                # penalise the new point with the largest lipschitz constant already in the batch, instead of
+                # estimating a new local one on a grid around it for every point added
+                local_lip_constant = max(self.lipschitz_batch_list, default = self.lipschitz_constant)
                 self.lipschitz_batch_list.append(local_lip_constant)
+                self.update_penalty_cache()
 
+        # stack the new queries once the batch is full
+        new_Xs = np.concatenate((new_Xs, *new_X_list))
+        new_Ms = np.concatenate((new_Ms, *new_M_list))
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
         # update model if there are new observations
@@ -1286,7 +1496,7 @@ class MultiTaskUCBwILP():
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 # redefine new maximum value
@@ -1329,33 +1539,23 @@ class MultiTaskUCBwILP():
 
         with torch.no_grad():
             # first center grid around pen_point
-            grid = torch.tensor(self.lipschitz_grid)
-            # now scale the grid by the lengthscales
-            if self.X[-1] != []:
-                lengthscale = self.model.model.covar_module_0.lengthscale.detach()
-            else:
-                hypers = self.gp_hyperparams
-                lengthscale = hypers[1]
-            # multiply grid by lengthscales and center
-            grid = (grid - grid[0]) * lengthscale + pen_point
-            # clamp grid in the correct bounds
-            bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
-            for j, (lb, ub) in enumerate(zip(*bounds)):
-                grid.data[..., j].clamp_(lb, ub)
+            grid = self.lipschitz_grid_t
+            # now scale the grid by the lengthscales, multiply grid by lengthscales and center
+            grid = (grid - grid[0]) * self.lipschitz_lengthscale + pen_point
+            # clamp grid in the correct bounds, broadcasting the (dim,) bounds over all grid points
+            grid.clamp_(self.bounds[0], self.bounds[1])
 
         # finally estimate lipschitz constant
-        grid = grid.clone().detach().double().requires_grad_(True)
+        grid = grid.double().requires_grad_(True)
         target_task_i = torch.zeros(size = (grid.shape[0], 1))
         # calculate mean of the GP
-        mean, _ = self.model.posterior(grid, target_task_i)
-        # calculate the gradient of the mean
-        external_grad = torch.ones(self.num_of_grad_points)
-        mean.backward(gradient = external_grad)
-        mu_grads = grid.grad
+        mean, _ = self.model.posterior_cached(grid, target_task_i)
+        # every mean only depends on its own grid point, so the gradient of the sum gives all the rows of the jacobian
+        mu_grads, = torch.autograd.grad(mean.sum(), grid)
         # find the norm of all the mean gradients
         mu_norm = torch.norm(mu_grads, dim = 1)
         # choose the largest one as our estimate
-        lipschitz_constant = max(mu_norm).item()
+        lipschitz_constant = mu_norm.max().item()
         return lipschitz_constant
     
     def build_af(self, X):
@@ -1365,34 +1565,57 @@ class MultiTaskUCBwILP():
         # we focus on the target task
         target_task_i = torch.zeros(size = (X.shape[0], 1))
         # calculate ucb
-        mean, std = self.model.posterior(X, target_task_i)
+        mean, std = self.model.posterior_cached(X, target_task_i)
         ucb = mean + self.beta * std
-        # check the batch of points being evaluated
-        batch = self.current_batch.copy()
-        # penalize acquisition function, loop through batch of evaluations
-        for i, penalty_point in enumerate(batch):
-            penalty_point = penalty_point.reshape(1, -1)
-            # re-define penalty point as tensor
-            penalty_point = torch.tensor(penalty_point)
-            # calculate mean and variance of model at penalty point
-            if self.X[-1] != []:
-                mean_pp, std_pp = self.model.posterior(penalty_point, torch.tensor(0).reshape(1, 1))
-            else:
-                hypers = self.gp_hyperparams
-                mean_constant = hypers[3]
-                constant = hypers[0]
-                mean_pp, std_pp = torch.tensor(mean_constant), torch.tensor(constant)
-            # calculate values of r_j
-            r_j = (self.max_value - mean_pp) / self.lipschitz_batch_list[i]
-            denominator = r_j + self.penalization_gamma * std_pp / self.lipschitz_batch_list[i]
-            # calculate norm between x and penalty point
-            norm = torch.norm(penalty_point - X, dim = 1)
-            # define penaliser
-            penaliser = torch.min(norm / denominator, torch.tensor(1))
-            # penalise ucb
-            ucb = ucb * penaliser
+        # penalize acquisition function with every point of the batch being evaluated at once
+        penalty_points, denominator = self.pp_cache
+        if penalty_points.shape[0] > 0:
+            ucb = penalise_ucb(ucb, penalty_points.to(X), X, denominator.to(X))
         return ucb
 
+    def update_batch_tensors(self):
+        '''
+        Wraps the points being evaluated and their fidelities as tensors once every time the batch changes, so that
+        information_gain and the penalty cache do not copy the same arrays again. The tensors share memory with the
+        numpy arrays, which are rebuilt rather than modified in place whenever a query is added.
+        '''
+        self.current_batch_t = torch.from_numpy(self.current_batch)
+        self.current_batch_fids_t = torch.from_numpy(self.current_batch_fids)
+
+    def fidelity_vectors(self, fidelity, batch_size):
+        '''
+        Returns the fidelity vector of the candidate points and the joint fidelity vector of the candidates at that
+        fidelity followed by the same candidates at the target fidelity. The acquisition function is evaluated with
+        the same batch size (number of starts, sobol grid) over and over, so the vectors are only built once.
+        '''
+        key = (fidelity, batch_size)
+        if key not in self.fidelity_vector_cache:
+            fidelity_vector = torch.full(size = (batch_size,), fill_value = fidelity)
+            target_fidelity_vector = torch.zeros(size = (batch_size,))
+            joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
+            self.fidelity_vector_cache[key] = (fidelity_vector, joint_fidelity_vector)
+        return self.fidelity_vector_cache[key]
+
+    def update_penalty_cache(self):
+        '''
+        Caches the penalty points of the current batch and the denominators of their penalisers, which do not change
+        while the acquisition function is optimised.
+        '''
+        penalty_points = self.current_batch_t.double().reshape(-1, self.dim)
+        lipschitz = torch.tensor(self.lipschitz_batch_list).double().reshape(-1)
+        num_of_points = penalty_points.shape[0]
+        # calculate mean and variance of model at the penalty points
+        if (self.X[-1] != []) & (num_of_points > 0):
+            with torch.no_grad():
+                mean_pp, std_pp = self.model.posterior_cached(penalty_points, torch.zeros(size = (num_of_points, 1)))
+        else:
+            mean_pp = torch.full((num_of_points,), float(self.mean_constant)).double()
+            std_pp = torch.full((num_of_points,), float(self.constant)).double()
+        # calculate values of r_j
+        r_j = (self.max_value - mean_pp) / lipschitz
+        denominator = r_j + self.penalization_gamma * std_pp / lipschitz
+        self.pp_cache = (penalty_points, denominator)
+
     def optimise_af(self):
         '''
         This function optimizes the acquisition function, and returns the next query point
@@ -1414,55 +1637,34 @@ class MultiTaskUCBwILP():
                 # choose the best point
                 best_idx = torch.argmax(af)
             # return the best value in the grid
-            best_input = X[best_idx, :].detach()
-            best = best_input.detach().numpy().reshape(1, -1)
-            new_X = best.reshape(1, -1)
+            new_X = X[best_idx, :].detach().cpu().numpy().reshape(1, -1)
             # choose fidelity level for this point
             new_M = self.generate_fidelity(new_X)
 
             return new_X, new_M
 
         # optimisation bounds
-        bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
+        bounds = self.bounds
         # sobol initialization initialization, on 100 * num_of_starts, check for best 10 and optimize from there
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-        X = sobol_gen.draw(100 * self.num_of_starts).double()
+        # the scrambled engine is created once in __init__ and keeps advancing along its sequence
+        X = self.sobol_gen.draw(100 * self.num_of_starts, dtype = torch.float64)
 
         with torch.no_grad():
             af = self.build_af(X)
-            idx_list = list(range(0, self.num_of_starts * 100))
-            sorted_af_idx = [idx for _, idx in sorted(zip(af, idx_list))]
-            best_idx = sorted_af_idx[-10:]
+            # choose the 10 best starts
+            _, best_idx = torch.topk(af, 10)
 
         # choose best starts for X
         X = X[best_idx, :]
-        X.requires_grad = True
-        # define optimiser
-        optimiser = torch.optim.Adam([X], lr = 0.01)
-        af = self.build_af(X)
-        
-        # do the optimisation
-        for _ in range(self.num_of_optim_epochs):
-            # set zero grad
-            optimiser.zero_grad()
-            # losses for optimiser
-            losses = -self.build_af(X)
-            loss = losses.sum()
-            loss.backward()
-            # optim step
-            optimiser.step()
-
-            # make sure we are still within the bounds
-            for j, (lb, ub) in enumerate(zip(*bounds)):
-                X.data[..., j].clamp_(lb, ub)
+        # optimise all starts jointly with L-BFGS-B, scipy handles the box constraints
+        X, af = gen_candidates_scipy(initial_conditions = X, acquisition_function = self.build_af, \
+            lower_bounds = bounds[0], upper_bounds = bounds[1], options = {'maxiter': self.num_of_optim_epochs})
         
         # find the best start
-        best_start = torch.argmax(-losses)
+        best_start = torch.argmax(af)
 
         # corresponding best input
-        best_input = X[best_start, :].detach()
-        best = best_input.detach().numpy().reshape(1, -1)
-        new_X = best.reshape(1, -1)
+        new_X = X[best_start, :].detach().cpu().numpy().reshape(1, -1)
 
         new_M = self.generate_fidelity(new_X)
         
@@ -1471,27 +1673,27 @@ class MultiTaskUCBwILP():
     def generate_fidelity(self, new_X):
         # now choose the corresponding fidelity
         if self.fidelity_choice == 'variance_thresholds':
-            for fidelity in reversed(range(self.num_of_fidelities)):
-                # set fidelity
-                new_M = torch.tensor(fidelity).reshape(1, 1)
-                # if we reach target fidelity, break
-                if fidelity == 0:
-                    break
-                # if there is data use posterior, else use prior
-                if self.X[-1] != []:
-                    _, std = self.model.posterior(new_X, new_M)
-                else:
-                    hypers = self.gp_hyperparams
-                    mean_constant = hypers[3]
-                    constant = hypers[0]
-                    _, std = torch.tensor(mean_constant), torch.tensor(constant)
-                # check fidelity thresholds
-                if self.increasing_thresholds:
-                    threshold = self.beta * std
-                else:
-                    threshold = std
-                if threshold > self.fidelity_thresholds[fidelity]:
-                    break
+            # standard deviation of every fidelity at new_X in a single posterior call, if there is no data use prior
+            if self.X[-1] != []:
+                fidelity_vector = torch.arange(self.num_of_fidelities).reshape(-1, 1)
+                new_X_rep = torch.as_tensor(new_X).double().reshape(1, -1).repeat(self.num_of_fidelities, 1)
+                with torch.no_grad():
+                    _, stds = self.model.posterior_cached(new_X_rep, fidelity_vector)
+                stds = stds.numpy()
+            else:
+                stds = np.full(self.num_of_fidelities, float(self.constant))
+            # check all fidelity thresholds at once
+            if self.increasing_thresholds:
+                thresholds = self.beta * stds
+            else:
+                thresholds = stds
+            above = thresholds[1:] > np.asarray(self.fidelity_thresholds[:self.num_of_fidelities], dtype = np.float64)[1:]
+            # the lowest fidelity is the one with the largest index, if none is above its threshold use target fidelity
+            above_idx = np.flatnonzero(above) + 1
+            if len(above_idx) > 0:
+                new_M = torch.tensor(int(above_idx[-1])).reshape(1, 1)
+            else:
+                new_M = torch.tensor(0).reshape(1, 1)
             
             return new_M
 
@@ -1500,42 +1702,47 @@ class MultiTaskUCBwILP():
                 new_X = torch.tensor(new_X).double()
             # self.generate_max_samples()
             IGs = torch.zeros(size = torch.Size([self.num_of_fidelities]))
-            for fidelity in range(0, self.num_of_fidelities):
-                IGs[fidelity] = self.information_gain(new_X, fidelity) / self.env.func.expected_costs[fidelity]
+            # no gradients are needed to choose the fidelity, so do not record the information gain graph
+            with torch.no_grad():
+                for fidelity in range(0, self.num_of_fidelities):
+                    IGs[fidelity] = self.information_gain(new_X, fidelity) / self.env.func.expected_costs[fidelity]
             new_M = torch.argmax(IGs).reshape(1, 1)
             return new_M
 
     def information_gain(self, X, fidelity):
         # X is batch size X dimension
         # fidelity is an integer, since we must optimize separately across all fidelities
-        current_batch = torch.tensor(self.current_batch)
-        current_batch_fids = torch.tensor(self.current_batch_fids)
+        current_batch = self.current_batch_t
+        current_batch_fids = self.current_batch_fids_t
         # batch size
         batch_size = X.shape[0]
-        fidelity_vector = torch.full(size = (batch_size,), fill_value = fidelity)
+        fidelity_vector, joint_fidelity_vector = self.fidelity_vectors(fidelity, batch_size)
         # reshape the max samples for calculations
         f_max_samples = self.f_max_samples.clone().reshape(1, -1).expand(batch_size, self.num_of_fantasies)
         num_max_samples = self.f_max_samples.shape[0]
-        # initialize standard normal distribution
-        standard_normal = torch.distributions.Normal(loc = 0, scale = 1)
         # if there is no batch being evaluated, do normal sequential MF-MSE
         if self.current_batch.shape[0] == 0:
             # calculate entropy of f(X, m) | D_t ; same procedure independently of fidelity
-            mu_m, sigma_m = self.model.posterior(X, fidelity_vector)
+            if fidelity == 0:
+                mu_m, sigma_m = self.model.posterior_cached(X, fidelity_vector)
+            else:
+                # lower fidelities also need the target fidelity and the covariance between both, all from one cached solve
+                means, stds, cross_covars = self.model.posterior_fidelities_cached(X, [0, fidelity])
+                mu_m, sigma_m = means[1], stds[1]
             mu_m, sigma_m = mu_m.reshape(-1, 1), sigma_m.reshape(-1, 1)
-            H_1 = torch.log(sigma_m * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))))
+            H_1 = torch.log(sigma_m) + HALF_LOG_2PIE
             # if we are querying target fidelity, use truncated normal approximation
             if fidelity == 0:
                 # calculate expected entropy of f(X, m) | f_*, D_t
                 # calculate gamma
                 gamma = (f_max_samples - mu_m) / (sigma_m + 1e-7)
                 # cdf and pdf terms
-                cdf_term = standard_normal.cdf(gamma)
-                pdf_term = torch.exp(standard_normal.log_prob(gamma))
+                cdf_term = std_normal_cdf(gamma)
+                pdf_term = std_normal_pdf(gamma)
                 # finally calculate entropy
-                # make sure value inside log is non-zero for numerical stability using masked_fill
-                inner_log = torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))) * sigma_m * cdf_term
-                log_term = torch.log(inner_log.masked_fill(inner_log <= 0, 1e-10))
+                # make sure value inside log is non-zero for numerical stability by clamping it
+                inner_log = SQRT_2PI_E * sigma_m * cdf_term
+                log_term = torch.log(inner_log.clamp_min(1e-10))
                 # second term
                 second_term = gamma * pdf_term / (2 * cdf_term + 1e-10)
                 # finally take Monte Carlo Estimate
@@ -1544,196 +1751,165 @@ class MultiTaskUCBwILP():
             
             # if we are not querying target fidelity, we need integral approximation
             elif fidelity != 0:
-                # define fidelity vectors
-                target_fidelity_vector = torch.zeros(size = (batch_size,))
-                joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
-                # obtain joint covariance matrix
-                with gpytorch.settings.fast_pred_var():
-                    out = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix = out.lazy_covariance_matrix
-                # obtain target fidelity mean vector
-                mu_0, sigma_0 = self.model.posterior(X, target_fidelity_vector)
-                mu_0, sigma_0 = mu_0.reshape(-1, 1), sigma_0.reshape(-1, 1)
-                # obtain smaller covariance matrix
-                covar_matrix_mM = covar_matrix[:batch_size, batch_size:]
-                covar_matrix_MM = covar_matrix[batch_size:, batch_size:]
+                # target fidelity posterior and its covariance with the current fidelity
+                mu_0, sigma_0 = means[0].reshape(-1, 1), stds[0].reshape(-1, 1)
                 # obtain variances
-                sigma_mM_sqrd = covar_matrix_mM.diag().reshape(-1, 1)
-                sigma_M_sqrd = covar_matrix_MM.diag().reshape(-1, 1)
+                sigma_mM_sqrd = cross_covars[1].reshape(-1, 1)
+                sigma_M_sqrd = sigma_0**2
                 # define s^2
                 s_sqrd = sigma_M_sqrd - (sigma_mM_sqrd)**2 / (sigma_m**2 + 1e-9)
-                # now we can define Psi(x)
-                def Psi(f):
-                    u_x = mu_0 + sigma_mM_sqrd * (f - mu_m) / (sigma_m**2 + 1e-9) # should be size: batch size x 1
-                    # cdf and pdf terms
-                    cdf_term = standard_normal.cdf((f_max_samples - u_x) / (torch.sqrt(s_sqrd) + 1e-9)) # should be size: batch size x samples
-                    pdf_term = torch.exp(standard_normal.log_prob((f - mu_m) / (sigma_m + 1e-9)))
-                    return cdf_term * pdf_term
+                # the integral is evaluated on self.device, so move everything it needs there
+                mu_0, sigma_0, mu_m, sigma_m = mu_0.to(self.device), sigma_0.to(self.device), mu_m.to(self.device), sigma_m.to(self.device)
+                sigma_mM_sqrd, s_sqrd = sigma_mM_sqrd.to(self.device), s_sqrd.to(self.device)
+                f_max_samples = f_max_samples.to(self.device)
+                # terms of Psi(x) that do not depend on f, computed once for the whole f grid
+                psi_coeff = sigma_mM_sqrd / (sigma_m**2 + 1e-9)
+                psi_cdf_scale = torch.sqrt(s_sqrd) + 1e-9
+                psi_pdf_scale = sigma_m + 1e-9
+                # u_x = mu_0 + psi_coeff * (f - mu_m) is linear in f, so the cdf argument splits into an offset and a slope
+                psi_cdf_offset = (f_max_samples - mu_0 + psi_coeff * mu_m) / psi_cdf_scale # should be size: batch size x samples
+                psi_cdf_slope = psi_coeff / psi_cdf_scale # should be size: batch size x 1
+                # Psi(f) = Phi(psi_cdf_offset - psi_cdf_slope * f) * phi((f - mu_m) / psi_pdf_scale)
                 # and define Z, add 1e-10 for numerical stability
-                inv_Z = standard_normal.cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
+                inv_Z = std_normal_cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
                 Z =  1 / inv_Z
                 # we can now estimate the one dimensional integral
                 # define integral range
-                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps)
-                # preallocate the space 
-                integral_grid = torch.zeros(size = (self.num_of_integration_steps, batch_size, num_max_samples))
-                # calculate corresponding y values
-                for idx, f in enumerate(f_range):
-                    z_psi = Z * Psi(f)
-                    # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                    z_psi = z_psi.masked_fill(z_psi <= 0, 1)
-                    y_vals = z_psi * torch.log(z_psi)
-                    if y_vals.isnan().any():
-                        print('stap')
-                    integral_grid[idx, :, :] = y_vals
-                # estimate integral using trapezium rule
-                integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps, dtype = mu_m.dtype, device = self.device)
+                # estimate the integral of Z * Psi(f) * log(Z * Psi(f)) with the trapezium rule, on the whole grid in one scripted call
+                integral_estimates = gaussian_entropy_integral(f_range, Z, psi_cdf_offset, psi_cdf_slope, mu_m, psi_pdf_scale)
+                if self.debug_nan_checks and integral_estimates.isnan().any():
+                    print('stap')
                 # now estimate H2 using Monte Carlo
-                H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
+                H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1).cpu()
             
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
             return H
         # otherwise do parallel optimization by considering queries being evaluated
         else:
             # define fidelity vectors
-            target_fidelity_vector = torch.zeros(size = (batch_size,))
-            joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
             # now calculate matrices
             with gpytorch.settings.fast_pred_var():
-                    # mean covariance matrix of vectors being evaluated
                     self.model.model.eval()
-                    dist_f_q = self.model.model(current_batch, current_batch_fids)
-                    # covar_matrix_q = dist_f_q.lazy_covariance_matrix
-                    covar_matrix_q = dist_f_q.covariance_matrix
-                    # if torch.linalg.det(covar_matrix_q.tensor) == 0:
-                    if torch.linalg.det(covar_matrix_q) == 0:
-                        # if matrix is singular, add jitter
-                        covar_matrix_q = covar_matrix_q + torch.diag(standard_normal.sample(torch.Size([covar_matrix_q.shape[0]])) * 1e-8)
-                    # covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q.tensor))
-                    covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q))
-                    mu_q = dist_f_q.mean.reshape(-1, 1) # q by 1
-                    # further, create samples from f_q
-                    f_q_samples = dist_f_q.sample(sample_shape=torch.Size([self.num_of_fantasies])) # size self.num_of_fantasies x q
+                    # joint posterior of current fidelity, target fidelity and points being evaluated, all blocks are sliced from it
+                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
+                    covar_matrix_MQ_full = out_Sigma_MQ.lazy_covariance_matrix
+                    mean_MQ_full = out_Sigma_MQ.mean
+                    # mean covariance matrix of vectors being evaluated
+                    covar_matrix_q = covar_matrix_MQ_full[2*batch_size:, 2*batch_size:].evaluate()
+                    # cholesky factor of the covariance, jitter starting at 1e-8 is only added (and increased) if the decomposition fails
+                    L_q = psd_safe_cholesky(covar_matrix_q, jitter = 1e-8, max_tries = 5)
+                    # further, create samples from f_q through the same cholesky factor, f_q = mu_q + L_q eps
+                    f_q_eps = torch.randn(covar_matrix_q.shape[0], self.num_of_fantasies, dtype = covar_matrix_q.dtype, device = covar_matrix_q.device) # size q x self.num_of_fantasies
                     # Sigma_M, covariance of current fidelity and target fidelity
-                    out_Sigma_M = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix_M = out_Sigma_M.lazy_covariance_matrix
-                    mean_sigma_M = out_Sigma_M.mean
+                    covar_matrix_M = covar_matrix_MQ_full[:2*batch_size, :2*batch_size]
+                    mean_sigma_M = mean_MQ_full[:2*batch_size]
                     mu_m = mean_sigma_M[:batch_size]
                     mu_0 = mean_sigma_M[batch_size:]
                     # Sigma_MQ, covariance of current fidelity, target fidelity and points being evaluated
-                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
-                    covar_matrix_MQ = out_Sigma_MQ.lazy_covariance_matrix[:2*batch_size, 2*batch_size:]
-            # calculate matrix product
-            covariance_matrix_given_q = covar_matrix_M - covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(covar_matrix_MQ.t())
+                    covar_matrix_MQ = covar_matrix_MQ_full[:2*batch_size, 2*batch_size:].evaluate()
+            # whiten the cross covariance with one triangular solve, A = L_q^-1 Sigma_QM, so Sigma_MQ Sigma_q^-1 Sigma_QM = A^T A
+            whitened_MQ = torch.linalg.solve_triangular(L_q, covar_matrix_MQ.t(), upper = False)
+            # only three diagonals of the conditional covariance are needed, so never form the dense 2B x 2B matrix
+            # the diagonal of A^T A is the column-wise sum of A * A, and the diagonal of its off-diagonal block pairs the two halves of A
+            diag_given_q = covar_matrix_M.diag() - (whitened_MQ * whitened_MQ).sum(dim = 0)
+            cross_diag_given_q = covar_matrix_M[:batch_size, batch_size:].diag() - (whitened_MQ[:, :batch_size] * whitened_MQ[:, batch_size:]).sum(dim = 0)
             # now obtain variances we need for calculations, avoid negative variances fue to numerical issues by taking maximum for small numbers
-            sigma_mM_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_m_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, :batch_size].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_M_sqrd_given_q = torch.maximum(covariance_matrix_given_q[batch_size:, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            if (sigma_M_sqrd_given_q < 0).any():
-                print('sad')
+            sigma_mM_sqrd_given_q = cross_diag_given_q.reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_m_sqrd_given_q = diag_given_q[:batch_size].reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_M_sqrd_given_q = diag_given_q[batch_size:].reshape(-1, 1).clamp_min(self.num_stability)
             # calculate f_star samples 
-            # first calculate mean: q x self.num_of_fantasies
-            fq_minus_mu_q = f_q_samples.T - mu_q.repeat(1, self.num_of_fantasies)
+            # f_q - mu_q = L_q eps, so the whitened residual L_q^-1 (f_q - mu_q) is simply eps
             # multiple by matrices to obtain final matrix of shape 2B x self.num_of_fantasies
-            mu_update = covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(fq_minus_mu_q)
-            mu_matrix = mean_sigma_M.reshape(-1, 1).repeat(1, self.num_of_fantasies) # now has shape 2B x self.num_of_fantasies
-            # finally obtain samples of mean of f given q
-            f_given_q_samples = mu_matrix + mu_update
+            mu_update = whitened_MQ.t().matmul(f_q_eps)
+            # finally obtain samples of mean of f given q, the (2B, 1) mean broadcasts against the (2B, self.num_of_fantasies) update
+            f_given_q_samples = mean_sigma_M.reshape(-1, 1) + mu_update
             # and with this, obtain f_star_samples
             f_star_samples = f_max_samples - f_given_q_samples[batch_size:, :]
-            # define nu function
+            # the integral is evaluated on self.device, so move everything it needs there
+            f_star_samples = f_star_samples.to(self.device)
+            sigma_mM_sqrd_given_q = sigma_mM_sqrd_given_q.to(self.device)
+            sigma_m_sqrd_given_q = sigma_m_sqrd_given_q.to(self.device)
+            sigma_M_sqrd_given_q = sigma_M_sqrd_given_q.to(self.device)
+            # terms of nu that do not depend on f, computed once for the whole f grid
+            sqrt_sm = sigma_m_sqrd_given_q.sqrt()
+            nu_coeff = sigma_mM_sqrd_given_q / sigma_m_sqrd_given_q
+            numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
+            # the denominator only depends on the f_star samples
+            denominator_cdf = std_normal_cdf(f_star_samples / (sigma_M_sqrd_given_q.sqrt()))
+            denominator = denominator_cdf * sqrt_sm + self.num_stability
+            if self.debug_nan_checks and ((denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any()):
+                print('yaaaa')
+            # the cdf argument in the numerator is linear in f, split it into an offset and a slope
+            nu_cdf_offset = f_star_samples / numerator_cdf_inner_denominator
+            nu_cdf_slope = nu_coeff / numerator_cdf_inner_denominator
+            # define nu function, f can be a scalar or an (integration steps, 1, 1) grid
             def nu(f):
                 # first the cdf in the numerator
-                numerator_cdf_inner_numerator = f_star_samples - sigma_mM_sqrd_given_q / (sigma_m_sqrd_given_q) * f
-                numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
-                numerator_cdf_inner = numerator_cdf_inner_numerator / numerator_cdf_inner_denominator
-                numerator_cdf = standard_normal.cdf(numerator_cdf_inner)
+                numerator_cdf = std_normal_cdf(nu_cdf_offset - nu_cdf_slope * f)
 
                 # now the pdf in the numerator
-                numerator_pdf_inner = f / (sigma_m_sqrd_given_q.sqrt())
-                numerator_pdf = torch.exp(standard_normal.log_prob(numerator_pdf_inner))
+                numerator_pdf = std_normal_pdf(f / sqrt_sm)
 
                 # define full numerator now
                 numerator = numerator_cdf * numerator_pdf
 
-                # denominator cdf
-                denominator_cdf_inner = f_star_samples / (sigma_M_sqrd_given_q.sqrt())
-                denominator_cdf = standard_normal.cdf(denominator_cdf_inner)
-
-                # define full denominator now
-                denominator = denominator_cdf * sigma_m_sqrd_given_q.sqrt() + self.num_stability
-
-                if (denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any():
-                    print('yaaaa')
-                
-                if numerator.isnan().any() or numerator.isinf().any():
+                if self.debug_nan_checks and (numerator.isnan().any() or numerator.isinf().any()):
                     print('yaaaa')
 
-                if (numerator / denominator > 1e10).any():
-                    a = 0
-
                 return numerator / (denominator)
             
             # define integration range
             f_limit_range = [10**int(i) for i in range(-6, 2)]
             with torch.no_grad():
-                for f in f_limit_range:
-                    latest_f = f
-                    max_nu_val = torch.max(nu(f))
-                    if max_nu_val < 1e-30:
-                        break
+                # evaluate nu at every candidate limit in one call, and use the first one where it has vanished
+                f_limits = torch.tensor(f_limit_range, dtype = f_star_samples.dtype, device = self.device).reshape(-1, 1, 1)
+                vanished = (nu(f_limits).amax(dim = (1, 2)) < 1e-30).tolist()
+            latest_f = f_limit_range[vanished.index(True)] if True in vanished else f_limit_range[-1]
             # define integral range
-            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps)
-            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps)
+            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps, dtype = f_star_samples.dtype, device = self.device)
+            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps, dtype = f_star_samples.dtype, device = self.device)
             f_range = torch.concat((left_linspace, right_linspace[1:]))
-            # preallocate the space 
-            integral_grid = torch.zeros(size = (self.num_of_integration_steps * 2 - 1, batch_size, self.num_of_fantasies))
-            # calculate corresponding y values
-            for idx, f in enumerate(f_range):
-                nu_preprocessed = nu(f)
-                # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                nu_processed = nu_preprocessed.masked_fill(nu_preprocessed <= 0, self.num_stability)
-                y_vals = nu_processed * torch.log(nu_processed)
-                if y_vals.isnan().any():
-                    print('stap')
-                integral_grid[idx, :, :] = y_vals
-            # estimate integral using trapezium rule
-            integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+            # estimate the integral of nu(f) * log(nu(f)) with the trapezium rule, on the whole grid in one scripted call
+            integral_estimates = gaussian_entropy_integral(f_range, 1 / denominator, nu_cdf_offset, nu_cdf_slope, torch.zeros_like(sqrt_sm), sqrt_sm)
+            if self.debug_nan_checks and integral_estimates.isnan().any():
+                print('stap')
             # now estimate H2 using Monte Carlo
             H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
 
-            # calculate H_1 which is analytical
-            H_1_inner = sigma_m_sqrd_given_q.sqrt() * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1)))
-            H_1_inner = H_1_inner.masked_fill(H_1_inner <= 0, self.num_stability)
-            H_1 = torch.log(H_1_inner)
+            # calculate H_1 which is analytical, the variance is already clamped away from zero
+            H_1 = 0.5 * torch.log(sigma_m_sqrd_given_q) + HALF_LOG_2PIE
 
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
-            return H
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
+            return H.cpu()
 
     def generate_max_samples(self, fidelity = 0):
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-        X_test_samples = sobol_gen.draw(100 * self.num_of_starts).double()
-        samples = self.model.generate_samples(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
+        X_test_samples = self.sobol_gen.draw(100 * self.num_of_starts, dtype = torch.float64)
+        samples = self.model.sample_posterior(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
         self.f_max_samples, _ = torch.max(samples, dim = 1)
 
 class MF_MES(MultiTaskUCBwILP):
-    def __init__(self, env, budget, cost_budget, num_of_latents=None, ranks=None, hp_update_frequency=None, num_of_starts=75, num_of_optim_epochs=25, beta=None, local_lipschitz=True, fidelity_thresholds=None, increasing_thresholds=False):
-        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds)
+    def __init__(self, env, budget, cost_budget, num_of_latents=None, ranks=None, hp_update_frequency=None, num_of_starts=75, num_of_optim_epochs=25, beta=None, local_lipschitz=True, fidelity_thresholds=None, increasing_thresholds=False, use_gpu=False):
+        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds, use_gpu = use_gpu)
         self.min_integration = -10
         self.max_integration = 10
         self.num_of_integration_steps = 250
         self.num_of_fantasies = 100
         self.num_stability = 1e-30
+        # dtype of the entropy integral grids, the posterior and its cholesky factors stay in double precision
+        self.integral_dtype = torch.float32
     
     def optim_loop(self):
         '''
@@ -1745,22 +1921,32 @@ class MF_MES(MultiTaskUCBwILP):
         # optimise acquisition function to obtain new queries until batch is full
         new_Xs = np.empty((0, self.dim))
         new_Ms = np.empty((0, 1))
+        new_X_list = []
+        new_M_list = []
         
         # obtain current batch
         self.current_batch = self.env.query_list.copy()
         self.current_batch_fids = self.env.fidelities_list.copy()
+        self.update_batch_tensors()
+        # the model does not change while the batch is filled, so the maximum samples are drawn once per batch
+        if (self.batch_costs < self.cost_budget) & (self.current_time > 0):
+            self.generate_max_samples()
 
         # fill batch
         while self.batch_costs < self.cost_budget:
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            new_X_list.append(new_X)
+            new_M_list.append(new_M)
             # add new_X and new_M to current batch
             self.current_batch = np.concatenate((self.current_batch, new_X))
             self.current_batch_fids = np.concatenate((self.current_batch_fids, new_M))
+            self.update_batch_tensors()
             # update batch costs
             self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
 
+        # stack the new queries once the batch is full
+        new_Xs = np.concatenate((new_Xs, *new_X_list))
+        new_Ms = np.concatenate((new_Ms, *new_M_list))
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
         # update model if there are new observations
@@ -1770,7 +1956,7 @@ class MF_MES(MultiTaskUCBwILP):
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 # redefine new maximum value
@@ -1799,34 +1985,37 @@ class MF_MES(MultiTaskUCBwILP):
     def build_af(self, X, fidelity):
         # X is batch size X dimension
         # fidelity is an integer, since we must optimize separately across all fidelities
-        current_batch = torch.tensor(self.current_batch)
-        current_batch_fids = torch.tensor(self.current_batch_fids)
+        current_batch = self.current_batch_t
+        current_batch_fids = self.current_batch_fids_t
         # batch size
         batch_size = X.shape[0]
-        fidelity_vector = torch.full(size = (batch_size,), fill_value = fidelity)
+        fidelity_vector, joint_fidelity_vector = self.fidelity_vectors(fidelity, batch_size)
         # reshape the max samples for calculations
         f_max_samples = self.f_max_samples.clone().reshape(1, -1).expand(batch_size, self.num_of_fantasies)
         num_max_samples = self.f_max_samples.shape[0]
-        # initialize standard normal distribution
-        standard_normal = torch.distributions.Normal(loc = 0, scale = 1)
         # if there is no batch being evaluated, do normal sequential MF-MSE
         if self.current_batch.shape[0] == 0:
             # calculate entropy of f(X, m) | D_t ; same procedure independently of fidelity
-            mu_m, sigma_m = self.model.posterior(X, fidelity_vector)
+            if fidelity == 0:
+                mu_m, sigma_m = self.model.posterior_cached(X, fidelity_vector)
+            else:
+                # lower fidelities also need the target fidelity and the covariance between both, all from one cached solve
+                means, stds, cross_covars = self.model.posterior_fidelities_cached(X, [0, fidelity])
+                mu_m, sigma_m = means[1], stds[1]
             mu_m, sigma_m = mu_m.reshape(-1, 1), sigma_m.reshape(-1, 1)
-            H_1 = torch.log(sigma_m * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))))
+            H_1 = torch.log(sigma_m) + HALF_LOG_2PIE
             # if we are querying target fidelity, use truncated normal approximation
             if fidelity == 0:
                 # calculate expected entropy of f(X, m) | f_*, D_t
                 # calculate gamma
                 gamma = (f_max_samples - mu_m) / (sigma_m + 1e-7)
                 # cdf and pdf terms
-                cdf_term = standard_normal.cdf(gamma)
-                pdf_term = torch.exp(standard_normal.log_prob(gamma))
+                cdf_term = std_normal_cdf(gamma)
+                pdf_term = std_normal_pdf(gamma)
                 # finally calculate entropy
-                # make sure value inside log is non-zero for numerical stability using masked_fill
-                inner_log = torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))) * sigma_m * cdf_term
-                log_term = torch.log(inner_log.masked_fill(inner_log <= 0, 1e-10))
+                # make sure value inside log is non-zero for numerical stability by clamping it
+                inner_log = SQRT_2PI_E * sigma_m * cdf_term
+                log_term = torch.log(inner_log.clamp_min(1e-10))
                 # second term
                 second_term = gamma * pdf_term / (2 * cdf_term + 1e-10)
                 # finally take Monte Carlo Estimate
@@ -1835,180 +2024,143 @@ class MF_MES(MultiTaskUCBwILP):
             
             # if we are not querying target fidelity, we need integral approximation
             elif fidelity != 0:
-                # define fidelity vectors
-                target_fidelity_vector = torch.zeros(size = (batch_size,))
-                joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
-                # obtain joint covariance matrix
-                with gpytorch.settings.fast_pred_var():
-                    out = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix = out.lazy_covariance_matrix
-                # obtain target fidelity mean vector
-                mu_0, sigma_0 = self.model.posterior(X, target_fidelity_vector)
-                mu_0, sigma_0 = mu_0.reshape(-1, 1), sigma_0.reshape(-1, 1)
-                # obtain smaller covariance matrix
-                covar_matrix_mM = covar_matrix[:batch_size, batch_size:]
-                covar_matrix_MM = covar_matrix[batch_size:, batch_size:]
+                # target fidelity posterior and its covariance with the current fidelity
+                mu_0, sigma_0 = means[0].reshape(-1, 1), stds[0].reshape(-1, 1)
                 # obtain variances
-                sigma_mM_sqrd = covar_matrix_mM.diag().reshape(-1, 1)
-                sigma_M_sqrd = covar_matrix_MM.diag().reshape(-1, 1)
+                sigma_mM_sqrd = cross_covars[1].reshape(-1, 1)
+                sigma_M_sqrd = sigma_0**2
                 # define s^2
                 s_sqrd = sigma_M_sqrd - (sigma_mM_sqrd)**2 / (sigma_m**2 + 1e-9)
-                # now we can define Psi(x)
-                def Psi(f):
-                    u_x = mu_0 + sigma_mM_sqrd * (f - mu_m) / (sigma_m**2 + 1e-9) # should be size: batch size x 1
-                    # cdf and pdf terms
-                    cdf_term = standard_normal.cdf((f_max_samples - u_x) / (torch.sqrt(s_sqrd) + 1e-9)) # should be size: batch size x samples
-                    pdf_term = torch.exp(standard_normal.log_prob((f - mu_m) / (sigma_m + 1e-9)))
-                    return cdf_term * pdf_term
+                # terms of Psi(x) that do not depend on f, computed once for the whole f grid
+                psi_coeff = sigma_mM_sqrd / (sigma_m**2 + 1e-9)
+                psi_cdf_scale = torch.sqrt(s_sqrd) + 1e-9
+                psi_pdf_scale = sigma_m + 1e-9
+                # u_x = mu_0 + psi_coeff * (f - mu_m) is linear in f, so the cdf argument splits into an offset and a slope
+                psi_cdf_offset = (f_max_samples - mu_0 + psi_coeff * mu_m) / psi_cdf_scale # should be size: batch size x samples
+                psi_cdf_slope = psi_coeff / psi_cdf_scale # should be size: batch size x 1
+                # Psi(f) = Phi(psi_cdf_offset - psi_cdf_slope * f) * phi((f - mu_m) / psi_pdf_scale)
                 # and define Z, add 1e-10 for numerical stability
-                inv_Z = standard_normal.cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
+                inv_Z = std_normal_cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
                 Z =  1 / inv_Z
                 # we can now estimate the one dimensional integral
                 # define integral range
-                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps)
-                # preallocate the space 
-                integral_grid = torch.zeros(size = (self.num_of_integration_steps, batch_size, num_max_samples))
-                # calculate corresponding y values
-                for idx, f in enumerate(f_range):
-                    z_psi = Z * Psi(f)
-                    # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                    z_psi = z_psi.masked_fill(z_psi <= 0, 1)
-                    y_vals = z_psi * torch.log(z_psi)
-                    if y_vals.isnan().any():
-                        print('stap')
-                    integral_grid[idx, :, :] = y_vals
-                # estimate integral using trapezium rule
-                integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps, dtype = self.integral_dtype, device = self.device)
+                # estimate the integral of Z * Psi(f) * log(Z * Psi(f)) with the trapezium rule, on the whole grid in one scripted call
+                # the grid is evaluated in self.integral_dtype on self.device, only the (batch size, samples) estimates come back in double precision
+                integral_args = [t.to(device = self.device, dtype = self.integral_dtype) for t in (Z, psi_cdf_offset, psi_cdf_slope, mu_m, psi_pdf_scale)]
+                integral_estimates = gaussian_entropy_integral(f_range, *integral_args).double().cpu()
+                if self.debug_nan_checks and integral_estimates.isnan().any():
+                    print('stap')
                 # now estimate H2 using Monte Carlo
                 H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
             
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
             return H
         # otherwise do parallel optimization by considering queries being evaluated
         else:
             # define fidelity vectors
-            target_fidelity_vector = torch.zeros(size = (batch_size,))
-            joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
             # now calculate matrices
             with gpytorch.settings.fast_pred_var():
-                    # mean covariance matrix of vectors being evaluated
                     self.model.model.eval()
-                    dist_f_q = self.model.model(current_batch, current_batch_fids)
-                    # covar_matrix_q = dist_f_q.lazy_covariance_matrix
-                    covar_matrix_q = dist_f_q.covariance_matrix
-                    # if torch.linalg.det(covar_matrix_q.tensor) == 0:
-                    if torch.linalg.det(covar_matrix_q) == 0:
-                        # if matrix is singular, add jitter
-                        covar_matrix_q = covar_matrix_q + torch.diag(standard_normal.sample(torch.Size([covar_matrix_q.shape[0]])) * 1e-8)
-                    # covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q.tensor))
-                    covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q))
-                    mu_q = dist_f_q.mean.reshape(-1, 1) # q by 1
-                    # further, create samples from f_q
-                    f_q_samples = dist_f_q.sample(sample_shape=torch.Size([self.num_of_fantasies])) # size self.num_of_fantasies x q
+                    # joint posterior of current fidelity, target fidelity and points being evaluated, all blocks are sliced from it
+                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
+                    covar_matrix_MQ_full = out_Sigma_MQ.lazy_covariance_matrix
+                    mean_MQ_full = out_Sigma_MQ.mean
+                    # mean covariance matrix of vectors being evaluated
+                    covar_matrix_q = covar_matrix_MQ_full[2*batch_size:, 2*batch_size:].evaluate()
+                    # cholesky factor of the covariance, jitter starting at 1e-8 is only added (and increased) if the decomposition fails
+                    L_q = psd_safe_cholesky(covar_matrix_q, jitter = 1e-8, max_tries = 5)
+                    # further, create samples from f_q through the same cholesky factor, f_q = mu_q + L_q eps
+                    f_q_eps = torch.randn(covar_matrix_q.shape[0], self.num_of_fantasies, dtype = covar_matrix_q.dtype, device = covar_matrix_q.device) # size q x self.num_of_fantasies
                     # Sigma_M, covariance of current fidelity and target fidelity
-                    out_Sigma_M = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix_M = out_Sigma_M.lazy_covariance_matrix
-                    mean_sigma_M = out_Sigma_M.mean
+                    covar_matrix_M = covar_matrix_MQ_full[:2*batch_size, :2*batch_size]
+                    mean_sigma_M = mean_MQ_full[:2*batch_size]
                     mu_m = mean_sigma_M[:batch_size]
                     mu_0 = mean_sigma_M[batch_size:]
                     # Sigma_MQ, covariance of current fidelity, target fidelity and points being evaluated
-                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
-                    covar_matrix_MQ = out_Sigma_MQ.lazy_covariance_matrix[:2*batch_size, 2*batch_size:]
-            # calculate matrix product
-            covariance_matrix_given_q = covar_matrix_M - covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(covar_matrix_MQ.t())
+                    covar_matrix_MQ = covar_matrix_MQ_full[:2*batch_size, 2*batch_size:].evaluate()
+            # whiten the cross covariance with one triangular solve, A = L_q^-1 Sigma_QM, so Sigma_MQ Sigma_q^-1 Sigma_QM = A^T A
+            whitened_MQ = torch.linalg.solve_triangular(L_q, covar_matrix_MQ.t(), upper = False)
+            # only three diagonals of the conditional covariance are needed, so never form the dense 2B x 2B matrix
+            # the diagonal of A^T A is the column-wise sum of A * A, and the diagonal of its off-diagonal block pairs the two halves of A
+            diag_given_q = covar_matrix_M.diag() - (whitened_MQ * whitened_MQ).sum(dim = 0)
+            cross_diag_given_q = covar_matrix_M[:batch_size, batch_size:].diag() - (whitened_MQ[:, :batch_size] * whitened_MQ[:, batch_size:]).sum(dim = 0)
             # now obtain variances we need for calculations, avoid negative variances fue to numerical issues by taking maximum for small numbers
-            sigma_mM_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_m_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, :batch_size].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_M_sqrd_given_q = torch.maximum(covariance_matrix_given_q[batch_size:, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            if (sigma_M_sqrd_given_q < 0).any():
-                print('sad')
+            sigma_mM_sqrd_given_q = cross_diag_given_q.reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_m_sqrd_given_q = diag_given_q[:batch_size].reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_M_sqrd_given_q = diag_given_q[batch_size:].reshape(-1, 1).clamp_min(self.num_stability)
             # calculate f_star samples 
-            # first calculate mean: q x self.num_of_fantasies
-            fq_minus_mu_q = f_q_samples.T - mu_q.repeat(1, self.num_of_fantasies)
+            # f_q - mu_q = L_q eps, so the whitened residual L_q^-1 (f_q - mu_q) is simply eps
             # multiple by matrices to obtain final matrix of shape 2B x self.num_of_fantasies
-            mu_update = covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(fq_minus_mu_q)
-            mu_matrix = mean_sigma_M.reshape(-1, 1).repeat(1, self.num_of_fantasies) # now has shape 2B x self.num_of_fantasies
-            # finally obtain samples of mean of f given q
-            f_given_q_samples = mu_matrix + mu_update
+            mu_update = whitened_MQ.t().matmul(f_q_eps)
+            # finally obtain samples of mean of f given q, the (2B, 1) mean broadcasts against the (2B, self.num_of_fantasies) update
+            f_given_q_samples = mean_sigma_M.reshape(-1, 1) + mu_update
             # and with this, obtain f_star_samples
             f_star_samples = f_max_samples - f_given_q_samples[batch_size:, :]
-            # define nu function
+            # terms of nu that do not depend on f, computed once for the whole f grid
+            sqrt_sm = sigma_m_sqrd_given_q.sqrt()
+            nu_coeff = sigma_mM_sqrd_given_q / sigma_m_sqrd_given_q
+            numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
+            # the cdf argument in the numerator is linear in f, split it into an offset and a slope
+            nu_cdf_offset = f_star_samples / numerator_cdf_inner_denominator
+            nu_cdf_slope = nu_coeff / numerator_cdf_inner_denominator
+            # the denominator only depends on the f_star samples
+            denominator_cdf = std_normal_cdf(f_star_samples / (sigma_M_sqrd_given_q.sqrt()))
+            denominator = denominator_cdf * sqrt_sm + self.num_stability
+            if self.debug_nan_checks and ((denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any()):
+                print('yaaaa')
+            # define nu function, f can be a scalar or an (integration steps, 1, 1) grid
             def nu(f):
                 # first the cdf in the numerator
-                numerator_cdf_inner_numerator = f_star_samples - sigma_mM_sqrd_given_q / (sigma_m_sqrd_given_q) * f
-                numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
-                numerator_cdf_inner = numerator_cdf_inner_numerator / numerator_cdf_inner_denominator
-                numerator_cdf = standard_normal.cdf(numerator_cdf_inner)
+                numerator_cdf = std_normal_cdf(nu_cdf_offset - nu_cdf_slope * f)
 
                 # now the pdf in the numerator
-                numerator_pdf_inner = f / (sigma_m_sqrd_given_q.sqrt())
-                numerator_pdf = torch.exp(standard_normal.log_prob(numerator_pdf_inner))
+                numerator_pdf = std_normal_pdf(f / sqrt_sm)
 
                 # define full numerator now
                 numerator = numerator_cdf * numerator_pdf
 
-                # denominator cdf
-                denominator_cdf_inner = f_star_samples / (sigma_M_sqrd_given_q.sqrt())
-                denominator_cdf = standard_normal.cdf(denominator_cdf_inner)
-
-                # define full denominator now
-                denominator = denominator_cdf * sigma_m_sqrd_given_q.sqrt() + self.num_stability
-
-                if (denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any():
-                    print('yaaaa')
-                
-                if numerator.isnan().any() or numerator.isinf().any():
+                if self.debug_nan_checks and (numerator.isnan().any() or numerator.isinf().any()):
                     print('yaaaa')
 
-                if (numerator / denominator > 1e10).any():
-                    a = 0
-
                 return numerator / (denominator)
             
             # define integration range
             f_limit_range = [10**int(i) for i in range(-6, 2)]
             with torch.no_grad():
-                for f in f_limit_range:
-                    latest_f = f
-                    max_nu_val = torch.max(nu(f))
-                    if max_nu_val < 1e-30:
-                        break
+                # evaluate nu at every candidate limit in one call, and use the first one where it has vanished
+                f_limits = torch.tensor(f_limit_range, dtype = f_star_samples.dtype, device = f_star_samples.device).reshape(-1, 1, 1)
+                vanished = (nu(f_limits).amax(dim = (1, 2)) < 1e-30).tolist()
+            latest_f = f_limit_range[vanished.index(True)] if True in vanished else f_limit_range[-1]
             # define integral range
-            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps)
-            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps)
+            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps, dtype = self.integral_dtype, device = self.device)
+            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps, dtype = self.integral_dtype, device = self.device)
             f_range = torch.concat((left_linspace, right_linspace[1:]))
-            # preallocate the space 
-            integral_grid = torch.zeros(size = (self.num_of_integration_steps * 2 - 1, batch_size, self.num_of_fantasies))
-            # calculate corresponding y values
-            for idx, f in enumerate(f_range):
-                nu_preprocessed = nu(f)
-                # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                nu_processed = nu_preprocessed.masked_fill(nu_preprocessed <= 0, self.num_stability)
-                y_vals = nu_processed * torch.log(nu_processed)
-                if y_vals.isnan().any():
-                    print('stap')
-                integral_grid[idx, :, :] = y_vals
-            # estimate integral using trapezium rule
-            integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+            # estimate the integral of nu(f) * log(nu(f)) with the trapezium rule, on the whole grid in one scripted call
+            # the grid is evaluated in self.integral_dtype on self.device, only the (batch size, samples) estimates come back in double precision
+            integral_args = [t.to(device = self.device, dtype = self.integral_dtype) for t in (1 / denominator, nu_cdf_offset, nu_cdf_slope, torch.zeros_like(sqrt_sm), sqrt_sm)]
+            integral_estimates = gaussian_entropy_integral(f_range, *integral_args).double().cpu()
+            if self.debug_nan_checks and integral_estimates.isnan().any():
+                print('stap')
             # now estimate H2 using Monte Carlo
             H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
 
-            # calculate H_1 which is analytical
-            H_1_inner = sigma_m_sqrd_given_q.sqrt() * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1)))
-            H_1_inner = H_1_inner.masked_fill(H_1_inner <= 0, self.num_stability)
-            H_1 = torch.log(H_1_inner)
+            # calculate H_1 which is analytical, the variance is already clamped away from zero
+            H_1 = 0.5 * torch.log(sigma_m_sqrd_given_q) + HALF_LOG_2PIE
 
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
             return H
             
     def optimise_af(self):
@@ -2021,9 +2173,6 @@ class MF_MES(MultiTaskUCBwILP):
             new_M = np.array(self.num_of_fidelities - 1).reshape(1, 1)
             return new_X, new_M
         
-        # if we are going to optimize, generate samples
-        self.generate_max_samples()
-        
         # if we are simply optimizing with grid search, to be used when there are constraints
         if self.grid_search is True:
             best_outputs = []
@@ -2040,9 +2189,7 @@ class MF_MES(MultiTaskUCBwILP):
                     # choose best outputs as well
                     best_output = torch.max(af)
                 # return the best value in the grid
-                best_input = X[best_idx, :].detach()
-                best = best_input.detach().numpy().reshape(1, -1)
-                new_X = best.reshape(1, -1)
+                new_X = X[best_idx, :].detach().cpu().numpy().reshape(1, -1)
                 # best output divided by cost
                 best_outputs.append(best_output / self.env.func.expected_costs[fidelity])
                 best_inputs.append(new_X)
@@ -2056,29 +2203,23 @@ class MF_MES(MultiTaskUCBwILP):
         best_outputs = []
         best_inputs = []
         for fidelity in range(self.num_of_fidelities):
-            # optimisation bounds
-            bounds = torch.stack([torch.zeros(self.dim), torch.ones(self.dim)])
             # sobol initialization initialization, on 100 * num_of_starts, check for best 10 and optimize from there
-            sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-            X = sobol_gen.draw(50 * self.num_of_starts).double()
+            X = self.sobol_gen.draw(50 * self.num_of_starts, dtype = torch.float64)
 
             with torch.no_grad():
                 af = self.build_af(X, int(fidelity))
-                idx_list = list(range(0, self.num_of_starts * 50))
-                sorted_af_idx = [idx for _, idx in sorted(zip(af, idx_list))]
-                best_idx = sorted_af_idx[-10:]
+                best_idx = torch.topk(af.reshape(-1), 10).indices
 
             # choose best starts for X
             X = X[best_idx, :]
             X.requires_grad = True
             # define optimiser
             optimiser = torch.optim.Adam([X], lr = 0.01)
-            af = self.build_af(X, fidelity = fidelity)
             
             # do the optimisation
             for _ in range(self.num_of_optim_epochs):
-                # set zero grad
-                optimiser.zero_grad()
+                # set zero grad, dropping the gradient instead of filling it with zeros
+                optimiser.zero_grad(set_to_none = True)
                 # losses for optimiser
                 losses = -self.build_af(X, fidelity = fidelity)
                 loss = losses.sum()
@@ -2086,20 +2227,19 @@ class MF_MES(MultiTaskUCBwILP):
                 # optim step
                 optimiser.step()
 
-                # make sure we are still within the bounds
-                for j, (lb, ub) in enumerate(zip(*bounds)):
-                    X.data[..., j].clamp_(lb, ub)
+                # make sure we are still within the bounds, clamping every dimension at once
+                X.data.clamp_(self.bounds[0], self.bounds[1])
                 
-            
+            # losses were computed before the last step and clamp, so evaluate the acquisition at the final starts
+            with torch.no_grad():
+                af = self.build_af(X, fidelity = fidelity)
             # find the best start
-            best_start = torch.argmax(-losses)
+            best_start = torch.argmax(af)
 
             # corresponding best input
-            best_input = X[best_start, :].detach()
-            best = best_input.detach().numpy().reshape(1, -1)
-            new_X = best.reshape(1, -1)
+            new_X = X[best_start, :].detach().cpu().numpy().reshape(1, -1)
             best_inputs.append(new_X)
-            best_outputs.append(torch.max(-losses).detach().numpy() / self.env.func.expected_costs[fidelity])
+            best_outputs.append(af[best_start].numpy() / self.env.func.expected_costs[fidelity])
 
         new_M = np.argmax(best_outputs)
         new_X = best_inputs[new_M]
@@ -2108,9 +2248,8 @@ class MF_MES(MultiTaskUCBwILP):
         return new_X, new_M
     
     def generate_max_samples(self, fidelity = 0):
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-        X_test_samples = sobol_gen.draw(100 * self.num_of_starts).double()
-        samples = self.model.generate_samples(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
+        X_test_samples = self.sobol_gen.draw(100 * self.num_of_starts, dtype = torch.float64)
+        samples = self.model.sample_posterior(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
         self.f_max_samples, _ = torch.max(samples, dim = 1)
 
 class MF_TuRBO(MultiTaskUCBwILP):
@@ -2127,9 +2266,10 @@ class MF_TuRBO(MultiTaskUCBwILP):
             local_lipschitz=True, 
             fidelity_thresholds=None, 
             increasing_thresholds=False,
-            fidelity_choice = 'variance_thresholds'):
+            fidelity_choice = 'variance_thresholds',
+            use_gpu=False):
         
-        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds)
+        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds, use_gpu = use_gpu)
         # way of choosing fidelity
         assert fidelity_choice in ['variance_thresholds', 'information_based']
         self.fidelity_choice = fidelity_choice
@@ -2193,7 +2333,7 @@ class MF_TuRBO(MultiTaskUCBwILP):
     ):
         # define variables
         model = self.model.model
-        X = torch.tensor(self.X[0]).double()
+        X = torch.tensor(np.array(self.X[0])).double()
         Y = torch.tensor(np.array(self.Y[0])).double()
 
         assert acqf in ("ts")
@@ -2215,8 +2355,8 @@ class MF_TuRBO(MultiTaskUCBwILP):
         # we focus only on thompson sampling as an acquisition function
         if acqf == "ts":
             dim = self.dim
-            sobol = torch.quasirandom.SobolEngine(dim, scramble=True)
-            pert = sobol.draw(n_candidates)
+            # reuse the scrambled sobol engine instead of building a new one for every batch
+            pert = self.sobol_gen.draw(n_candidates, dtype = torch.float64)
             pert = tr_lb + (tr_ub - tr_lb) * pert
 
             # Create a perturbation mask
@@ -2228,11 +2368,8 @@ class MF_TuRBO(MultiTaskUCBwILP):
             ind = torch.where(mask.sum(dim=1) == 0)[0]
             mask[ind, torch.randint(0, dim - 1, size=(len(ind),))] = 1
 
-            # Create candidate points from the perturbations and the mask        
-            X_cand = x_center.expand(n_candidates, dim).clone()
-            # X_cand[mask]= pert[mask].double() 
-            X_cand = X_cand.double()
-            X_cand[mask] = pert[mask]
+            # Create candidate points from the perturbations and the mask, in one select without cloning the center
+            X_cand = torch.where(mask, pert.double(), x_center.double().expand(n_candidates, dim))
 
             # Sample on the candidate points
             # set model to evaluation mode
@@ -2254,10 +2391,13 @@ class MF_TuRBO(MultiTaskUCBwILP):
         # optimise acquisition function to obtain new queries until batch is full
         new_Xs = np.empty((0, self.dim))
         new_Ms = np.empty((0, 1))
+        new_X_list = []
+        new_M_list = []
         
         # obtain current batch
         self.current_batch = self.env.query_list.copy()
         self.current_batch_fids = self.env.fidelities_list.copy()
+        self.update_batch_tensors()
         # generate maximum samples if we are going to use information based fidelity selection
         if (self.batch_costs < self.cost_budget) & (self.fidelity_choice == 'information_based') & (self.current_time > 0):
             self.generate_max_samples()
@@ -2265,14 +2405,18 @@ class MF_TuRBO(MultiTaskUCBwILP):
         while self.batch_costs < self.cost_budget:
 #            self.lipshitz_batch_list = []
             new_X, new_M = self.optimise_af()
-            new_Xs = np.concatenate((new_Xs, new_X))
-            new_Ms = np.concatenate((new_Ms, new_M))
+            new_X_list.append(new_X)
+            new_M_list.append(new_M)
             # add new_X and new_M to current batch
             self.current_batch = np.concatenate((self.current_batch, new_X))
             self.current_batch_fids = np.concatenate((self.current_batch_fids, new_M))
+            self.update_batch_tensors()
             # update batch costs
             self.batch_costs = self.batch_costs + self.env.func.fidelity_costs[int(new_M)]
 
+        # stack the new queries once the batch is full
+        new_Xs = np.concatenate((new_Xs, *new_X_list))
+        new_Ms = np.concatenate((new_Ms, *new_M_list))
         obtain_query, obtain_fidelities, self.new_obs = self.env.step(new_Xs, new_Ms)
 
         # update model if there are new observations
@@ -2282,7 +2426,7 @@ class MF_TuRBO(MultiTaskUCBwILP):
             for i in range(num_of_obs):
                 # append new observations and the time at which they were observed
                 fid = int(obtain_fidelities[i])
-                self.X[fid].append(list(obtain_query[i, :].reshape(-1)))
+                self.X[fid].append(obtain_query[i, :].copy())
                 self.Y[fid].append(self.new_obs[i])
                 self.T[fid].append(self.current_time + 1)
                 # take away batch cost
@@ -2312,27 +2456,27 @@ class MF_TuRBO(MultiTaskUCBwILP):
     def generate_fidelity(self, new_X):
         # now choose the corresponding fidelity
         if self.fidelity_choice == 'variance_thresholds':
-            for fidelity in reversed(range(self.num_of_fidelities)):
-                # set fidelity
-                new_M = torch.tensor(fidelity).reshape(1, 1)
-                # if we reach target fidelity, break
-                if fidelity == 0:
-                    break
-                # if there is data use posterior, else use prior
-                if self.X[-1] != []:
-                    _, std = self.model.posterior(new_X, new_M)
-                else:
-                    hypers = self.gp_hyperparams
-                    mean_constant = hypers[3]
-                    constant = hypers[0]
-                    _, std = torch.tensor(mean_constant), torch.tensor(constant)
-                # check fidelity thresholds
-                if self.increasing_thresholds:
-                    threshold = self.beta * std
-                else:
-                    threshold = std
-                if threshold > self.fidelity_thresholds[fidelity]:
-                    break
+            # standard deviation of every fidelity at new_X in a single posterior call, if there is no data use prior
+            if self.X[-1] != []:
+                fidelity_vector = torch.arange(self.num_of_fidelities).reshape(-1, 1)
+                new_X_rep = torch.as_tensor(new_X).double().reshape(1, -1).repeat(self.num_of_fidelities, 1)
+                with torch.no_grad():
+                    _, stds = self.model.posterior_cached(new_X_rep, fidelity_vector)
+                stds = stds.numpy()
+            else:
+                stds = np.full(self.num_of_fidelities, float(self.constant))
+            # check all fidelity thresholds at once
+            if self.increasing_thresholds:
+                thresholds = self.beta * stds
+            else:
+                thresholds = stds
+            above = thresholds[1:] > np.asarray(self.fidelity_thresholds[:self.num_of_fidelities], dtype = np.float64)[1:]
+            # the lowest fidelity is the one with the largest index, if none is above its threshold use target fidelity
+            above_idx = np.flatnonzero(above) + 1
+            if len(above_idx) > 0:
+                new_M = torch.tensor(int(above_idx[-1])).reshape(1, 1)
+            else:
+                new_M = torch.tensor(0).reshape(1, 1)
             
             return new_M
 
@@ -2341,42 +2485,47 @@ class MF_TuRBO(MultiTaskUCBwILP):
                 new_X = torch.tensor(new_X).double()
             # self.generate_max_samples()
             IGs = torch.zeros(size = torch.Size([self.num_of_fidelities]))
-            for fidelity in range(0, self.num_of_fidelities):
-                IGs[fidelity] = self.information_gain(new_X, fidelity) / self.env.func.expected_costs[fidelity]
+            # no gradients are needed to choose the fidelity, so do not record the information gain graph
+            with torch.no_grad():
+                for fidelity in range(0, self.num_of_fidelities):
+                    IGs[fidelity] = self.information_gain(new_X, fidelity) / self.env.func.expected_costs[fidelity]
             new_M = torch.argmax(IGs).reshape(1, 1)
             return new_M
     
     def information_gain(self, X, fidelity):
         # X is batch size X dimension
         # fidelity is an integer, since we must optimize separately across all fidelities
-        current_batch = torch.tensor(self.current_batch)
-        current_batch_fids = torch.tensor(self.current_batch_fids)
+        current_batch = self.current_batch_t
+        current_batch_fids = self.current_batch_fids_t
         # batch size
         batch_size = X.shape[0]
-        fidelity_vector = torch.full(size = (batch_size,), fill_value = fidelity)
+        fidelity_vector, joint_fidelity_vector = self.fidelity_vectors(fidelity, batch_size)
         # reshape the max samples for calculations
         f_max_samples = self.f_max_samples.clone().reshape(1, -1).expand(batch_size, self.num_of_fantasies)
         num_max_samples = self.f_max_samples.shape[0]
-        # initialize standard normal distribution
-        standard_normal = torch.distributions.Normal(loc = 0, scale = 1)
         # if there is no batch being evaluated, do normal sequential MF-MSE
         if self.current_batch.shape[0] == 0:
             # calculate entropy of f(X, m) | D_t ; same procedure independently of fidelity
-            mu_m, sigma_m = self.model.posterior(X, fidelity_vector)
+            if fidelity == 0:
+                mu_m, sigma_m = self.model.posterior_cached(X, fidelity_vector)
+            else:
+                # lower fidelities also need the target fidelity and the covariance between both, all from one cached solve
+                means, stds, cross_covars = self.model.posterior_fidelities_cached(X, [0, fidelity])
+                mu_m, sigma_m = means[1], stds[1]
             mu_m, sigma_m = mu_m.reshape(-1, 1), sigma_m.reshape(-1, 1)
-            H_1 = torch.log(sigma_m * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))))
+            H_1 = torch.log(sigma_m) + HALF_LOG_2PIE
             # if we are querying target fidelity, use truncated normal approximation
             if fidelity == 0:
                 # calculate expected entropy of f(X, m) | f_*, D_t
                 # calculate gamma
                 gamma = (f_max_samples - mu_m) / (sigma_m + 1e-7)
                 # cdf and pdf terms
-                cdf_term = standard_normal.cdf(gamma)
-                pdf_term = torch.exp(standard_normal.log_prob(gamma))
+                cdf_term = std_normal_cdf(gamma)
+                pdf_term = std_normal_pdf(gamma)
                 # finally calculate entropy
-                # make sure value inside log is non-zero for numerical stability using masked_fill
-                inner_log = torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1))) * sigma_m * cdf_term
-                log_term = torch.log(inner_log.masked_fill(inner_log <= 0, 1e-10))
+                # make sure value inside log is non-zero for numerical stability by clamping it
+                inner_log = SQRT_2PI_E * sigma_m * cdf_term
+                log_term = torch.log(inner_log.clamp_min(1e-10))
                 # second term
                 second_term = gamma * pdf_term / (2 * cdf_term + 1e-10)
                 # finally take Monte Carlo Estimate
@@ -2385,191 +2534,158 @@ class MF_TuRBO(MultiTaskUCBwILP):
             
             # if we are not querying target fidelity, we need integral approximation
             elif fidelity != 0:
-                # define fidelity vectors
-                target_fidelity_vector = torch.zeros(size = (batch_size,))
-                joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
-                # obtain joint covariance matrix
-                with gpytorch.settings.fast_pred_var():
-                    out = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix = out.lazy_covariance_matrix
-                # obtain target fidelity mean vector
-                mu_0, sigma_0 = self.model.posterior(X, target_fidelity_vector)
-                mu_0, sigma_0 = mu_0.reshape(-1, 1), sigma_0.reshape(-1, 1)
-                # obtain smaller covariance matrix
-                covar_matrix_mM = covar_matrix[:batch_size, batch_size:]
-                covar_matrix_MM = covar_matrix[batch_size:, batch_size:]
+                # target fidelity posterior and its covariance with the current fidelity
+                mu_0, sigma_0 = means[0].reshape(-1, 1), stds[0].reshape(-1, 1)
                 # obtain variances
-                sigma_mM_sqrd = covar_matrix_mM.diag().reshape(-1, 1)
-                sigma_M_sqrd = covar_matrix_MM.diag().reshape(-1, 1)
+                sigma_mM_sqrd = cross_covars[1].reshape(-1, 1)
+                sigma_M_sqrd = sigma_0**2
                 # define s^2
                 s_sqrd = sigma_M_sqrd - (sigma_mM_sqrd)**2 / (sigma_m**2 + 1e-9)
-                # now we can define Psi(x)
-                def Psi(f):
-                    u_x = mu_0 + sigma_mM_sqrd * (f - mu_m) / (sigma_m**2 + 1e-9) # should be size: batch size x 1
-                    # cdf and pdf terms
-                    cdf_term = standard_normal.cdf((f_max_samples - u_x) / (torch.sqrt(s_sqrd) + 1e-9)) # should be size: batch size x samples
-                    pdf_term = torch.exp(standard_normal.log_prob((f - mu_m) / (sigma_m + 1e-9)))
-                    return cdf_term * pdf_term
+                # the integral is evaluated on self.device, so move everything it needs there
+                mu_0, sigma_0, mu_m, sigma_m = mu_0.to(self.device), sigma_0.to(self.device), mu_m.to(self.device), sigma_m.to(self.device)
+                sigma_mM_sqrd, s_sqrd = sigma_mM_sqrd.to(self.device), s_sqrd.to(self.device)
+                f_max_samples = f_max_samples.to(self.device)
+                # terms of Psi(x) that do not depend on f, computed once for the whole f grid
+                psi_coeff = sigma_mM_sqrd / (sigma_m**2 + 1e-9)
+                psi_cdf_scale = torch.sqrt(s_sqrd) + 1e-9
+                psi_pdf_scale = sigma_m + 1e-9
+                # u_x = mu_0 + psi_coeff * (f - mu_m) is linear in f, so the cdf argument splits into an offset and a slope
+                psi_cdf_offset = (f_max_samples - mu_0 + psi_coeff * mu_m) / psi_cdf_scale # should be size: batch size x samples
+                psi_cdf_slope = psi_coeff / psi_cdf_scale # should be size: batch size x 1
+                # Psi(f) = Phi(psi_cdf_offset - psi_cdf_slope * f) * phi((f - mu_m) / psi_pdf_scale)
                 # and define Z, add 1e-10 for numerical stability
-                inv_Z = standard_normal.cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
+                inv_Z = std_normal_cdf((f_max_samples - mu_0) / (sigma_0 + 1e-9)) * sigma_m + 1e-10
                 Z =  1 / inv_Z
                 # we can now estimate the one dimensional integral
                 # define integral range
-                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps)
-                # preallocate the space 
-                integral_grid = torch.zeros(size = (self.num_of_integration_steps, batch_size, num_max_samples))
-                # calculate corresponding y values
-                for idx, f in enumerate(f_range):
-                    z_psi = Z * Psi(f)
-                    # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                    z_psi = z_psi.masked_fill(z_psi <= 0, 1)
-                    y_vals = z_psi * torch.log(z_psi)
-                    if y_vals.isnan().any():
-                        print('stap')
-                    integral_grid[idx, :, :] = y_vals
-                # estimate integral using trapezium rule
-                integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+                f_range = torch.linspace(self.min_integration, self.max_integration, steps = self.num_of_integration_steps, dtype = mu_m.dtype, device = self.device)
+                # estimate the integral of Z * Psi(f) * log(Z * Psi(f)) with the trapezium rule, on the whole grid in one scripted call
+                integral_estimates = gaussian_entropy_integral(f_range, Z, psi_cdf_offset, psi_cdf_slope, mu_m, psi_pdf_scale)
+                if self.debug_nan_checks and integral_estimates.isnan().any():
+                    print('stap')
                 # now estimate H2 using Monte Carlo
-                H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
+                H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1).cpu()
             
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
             return H
         # otherwise do parallel optimization by considering queries being evaluated
         else:
             # define fidelity vectors
-            target_fidelity_vector = torch.zeros(size = (batch_size,))
-            joint_fidelity_vector = torch.concat((fidelity_vector, target_fidelity_vector))
             # now calculate matrices
             with gpytorch.settings.fast_pred_var():
-                    # mean covariance matrix of vectors being evaluated
                     self.model.model.eval()
-                    dist_f_q = self.model.model(current_batch, current_batch_fids)
-                    # covar_matrix_q = dist_f_q.lazy_covariance_matrix
-                    covar_matrix_q = dist_f_q.covariance_matrix
-                    # if torch.linalg.det(covar_matrix_q.tensor) == 0:
-                    if torch.linalg.det(covar_matrix_q) == 0:
-                        # if matrix is singular, add jitter
-                        covar_matrix_q = covar_matrix_q + torch.diag(standard_normal.sample(torch.Size([covar_matrix_q.shape[0]])) * 1e-8)
-                    # covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q.tensor))
-                    covar_matrix_q_inv = gpytorch.lazify(torch.inverse(covar_matrix_q))
-                    mu_q = dist_f_q.mean.reshape(-1, 1) # q by 1
-                    # further, create samples from f_q
-                    f_q_samples = dist_f_q.sample(sample_shape=torch.Size([self.num_of_fantasies])) # size self.num_of_fantasies x q
+                    # joint posterior of current fidelity, target fidelity and points being evaluated, all blocks are sliced from it
+                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
+                    covar_matrix_MQ_full = out_Sigma_MQ.lazy_covariance_matrix
+                    mean_MQ_full = out_Sigma_MQ.mean
+                    # mean covariance matrix of vectors being evaluated
+                    covar_matrix_q = covar_matrix_MQ_full[2*batch_size:, 2*batch_size:].evaluate()
+                    # cholesky factor of the covariance, jitter starting at 1e-8 is only added (and increased) if the decomposition fails
+                    L_q = psd_safe_cholesky(covar_matrix_q, jitter = 1e-8, max_tries = 5)
+                    # further, create samples from f_q through the same cholesky factor, f_q = mu_q + L_q eps
+                    f_q_eps = torch.randn(covar_matrix_q.shape[0], self.num_of_fantasies, dtype = covar_matrix_q.dtype, device = covar_matrix_q.device) # size q x self.num_of_fantasies
                     # Sigma_M, covariance of current fidelity and target fidelity
-                    out_Sigma_M = self.model.model(X.repeat(2, 1), joint_fidelity_vector)
-                    covar_matrix_M = out_Sigma_M.lazy_covariance_matrix
-                    mean_sigma_M = out_Sigma_M.mean
+                    covar_matrix_M = covar_matrix_MQ_full[:2*batch_size, :2*batch_size]
+                    mean_sigma_M = mean_MQ_full[:2*batch_size]
                     mu_m = mean_sigma_M[:batch_size]
                     mu_0 = mean_sigma_M[batch_size:]
                     # Sigma_MQ, covariance of current fidelity, target fidelity and points being evaluated
-                    out_Sigma_MQ = self.model.model(torch.cat((X.repeat(2, 1), current_batch)), torch.cat((joint_fidelity_vector, current_batch_fids.reshape(-1))))
-                    covar_matrix_MQ = out_Sigma_MQ.lazy_covariance_matrix[:2*batch_size, 2*batch_size:]
-            # calculate matrix product
-            covariance_matrix_given_q = covar_matrix_M - covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(covar_matrix_MQ.t())
+                    covar_matrix_MQ = covar_matrix_MQ_full[:2*batch_size, 2*batch_size:].evaluate()
+            # whiten the cross covariance with one triangular solve, A = L_q^-1 Sigma_QM, so Sigma_MQ Sigma_q^-1 Sigma_QM = A^T A
+            whitened_MQ = torch.linalg.solve_triangular(L_q, covar_matrix_MQ.t(), upper = False)
+            # only three diagonals of the conditional covariance are needed, so never form the dense 2B x 2B matrix
+            # the diagonal of A^T A is the column-wise sum of A * A, and the diagonal of its off-diagonal block pairs the two halves of A
+            diag_given_q = covar_matrix_M.diag() - (whitened_MQ * whitened_MQ).sum(dim = 0)
+            cross_diag_given_q = covar_matrix_M[:batch_size, batch_size:].diag() - (whitened_MQ[:, :batch_size] * whitened_MQ[:, batch_size:]).sum(dim = 0)
             # now obtain variances we need for calculations, avoid negative variances fue to numerical issues by taking maximum for small numbers
-            sigma_mM_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_m_sqrd_given_q = torch.maximum(covariance_matrix_given_q[:batch_size, :batch_size].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            sigma_M_sqrd_given_q = torch.maximum(covariance_matrix_given_q[batch_size:, batch_size:].diag().reshape(-1, 1), torch.tensor(self.num_stability))
-            if (sigma_M_sqrd_given_q < 0).any():
-                print('sad')
+            sigma_mM_sqrd_given_q = cross_diag_given_q.reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_m_sqrd_given_q = diag_given_q[:batch_size].reshape(-1, 1).clamp_min(self.num_stability)
+            sigma_M_sqrd_given_q = diag_given_q[batch_size:].reshape(-1, 1).clamp_min(self.num_stability)
             # calculate f_star samples 
-            # first calculate mean: q x self.num_of_fantasies
-            fq_minus_mu_q = f_q_samples.T - mu_q.repeat(1, self.num_of_fantasies)
+            # f_q - mu_q = L_q eps, so the whitened residual L_q^-1 (f_q - mu_q) is simply eps
             # multiple by matrices to obtain final matrix of shape 2B x self.num_of_fantasies
-            mu_update = covar_matrix_MQ.matmul(covar_matrix_q_inv).matmul(fq_minus_mu_q)
-            mu_matrix = mean_sigma_M.reshape(-1, 1).repeat(1, self.num_of_fantasies) # now has shape 2B x self.num_of_fantasies
-            # finally obtain samples of mean of f given q
-            f_given_q_samples = mu_matrix + mu_update
+            mu_update = whitened_MQ.t().matmul(f_q_eps)
+            # finally obtain samples of mean of f given q, the (2B, 1) mean broadcasts against the (2B, self.num_of_fantasies) update
+            f_given_q_samples = mean_sigma_M.reshape(-1, 1) + mu_update
             # and with this, obtain f_star_samples
             f_star_samples = f_max_samples - f_given_q_samples[batch_size:, :]
-            # define nu function
+            # the integral is evaluated on self.device, so move everything it needs there
+            f_star_samples = f_star_samples.to(self.device)
+            sigma_mM_sqrd_given_q = sigma_mM_sqrd_given_q.to(self.device)
+            sigma_m_sqrd_given_q = sigma_m_sqrd_given_q.to(self.device)
+            sigma_M_sqrd_given_q = sigma_M_sqrd_given_q.to(self.device)
+            # terms of nu that do not depend on f, computed once for the whole f grid
+            sqrt_sm = sigma_m_sqrd_given_q.sqrt()
+            nu_coeff = sigma_mM_sqrd_given_q / sigma_m_sqrd_given_q
+            numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
+            # the denominator only depends on the f_star samples
+            denominator_cdf = std_normal_cdf(f_star_samples / (sigma_M_sqrd_given_q.sqrt()))
+            denominator = denominator_cdf * sqrt_sm + self.num_stability
+            if self.debug_nan_checks and ((denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any()):
+                print('yaaaa')
+            # the cdf argument in the numerator is linear in f, split it into an offset and a slope
+            nu_cdf_offset = f_star_samples / numerator_cdf_inner_denominator
+            nu_cdf_slope = nu_coeff / numerator_cdf_inner_denominator
+            # define nu function, f can be a scalar or an (integration steps, 1, 1) grid
             def nu(f):
                 # first the cdf in the numerator
-                numerator_cdf_inner_numerator = f_star_samples - sigma_mM_sqrd_given_q / (sigma_m_sqrd_given_q) * f
-                numerator_cdf_inner_denominator = sigma_M_sqrd_given_q - sigma_mM_sqrd_given_q**2 / (sigma_m_sqrd_given_q) + self.num_stability
-                numerator_cdf_inner = numerator_cdf_inner_numerator / numerator_cdf_inner_denominator
-                numerator_cdf = standard_normal.cdf(numerator_cdf_inner)
+                numerator_cdf = std_normal_cdf(nu_cdf_offset - nu_cdf_slope * f)
 
                 # now the pdf in the numerator
-                numerator_pdf_inner = f / (sigma_m_sqrd_given_q.sqrt())
-                numerator_pdf = torch.exp(standard_normal.log_prob(numerator_pdf_inner))
+                numerator_pdf = std_normal_pdf(f / sqrt_sm)
 
                 # define full numerator now
                 numerator = numerator_cdf * numerator_pdf
 
-                # denominator cdf
-                denominator_cdf_inner = f_star_samples / (sigma_M_sqrd_given_q.sqrt())
-                denominator_cdf = standard_normal.cdf(denominator_cdf_inner)
-
-                # define full denominator now
-                denominator = denominator_cdf * sigma_m_sqrd_given_q.sqrt() + self.num_stability
-
-                if (denominator == 0).any() or denominator.isnan().any() or denominator.isinf().any():
+                if self.debug_nan_checks and (numerator.isnan().any() or numerator.isinf().any()):
                     print('yaaaa')
-                
-                if numerator.isnan().any() or numerator.isinf().any():
-                    print('yaaaa')
-
-                if (numerator / denominator > 1e10).any():
-                    a = 0
 
                 return numerator / (denominator)
             
             # define integration range
             f_limit_range = [10**int(i) for i in range(-6, 2)]
             with torch.no_grad():
-                for f in f_limit_range:
-                    latest_f = f
-                    max_nu_val = torch.max(nu(f))
-                    if max_nu_val < 1e-30:
-                        break
+                # evaluate nu at every candidate limit in one call, and use the first one where it has vanished
+                f_limits = torch.tensor(f_limit_range, dtype = f_star_samples.dtype, device = self.device).reshape(-1, 1, 1)
+                vanished = (nu(f_limits).amax(dim = (1, 2)) < 1e-30).tolist()
+            latest_f = f_limit_range[vanished.index(True)] if True in vanished else f_limit_range[-1]
             # define integral range
-            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps)
-            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps)
+            left_linspace = torch.linspace(-latest_f, 0, steps = self.num_of_integration_steps, dtype = f_star_samples.dtype, device = self.device)
+            right_linspace = torch.linspace(0, latest_f, steps = self.num_of_integration_steps, dtype = f_star_samples.dtype, device = self.device)
             f_range = torch.concat((left_linspace, right_linspace[1:]))
-            # preallocate the space 
-            integral_grid = torch.zeros(size = (self.num_of_integration_steps * 2 - 1, batch_size, self.num_of_fantasies))
-            # calculate corresponding y values
-            for idx, f in enumerate(f_range):
-                nu_preprocessed = nu(f)
-                # recall that limit of x * log(x) as x-> 0 is 0; but computationally we get nans, so set it to 1 to obtain correct values
-                nu_processed = nu_preprocessed.masked_fill(nu_preprocessed <= 0, self.num_stability)
-                y_vals = nu_processed * torch.log(nu_processed)
-                if y_vals.isnan().any():
-                    print('stap')
-                integral_grid[idx, :, :] = y_vals
-            # estimate integral using trapezium rule
-            integral_estimates = torch.trapezoid(integral_grid, f_range, dim = 0)
+            # estimate the integral of nu(f) * log(nu(f)) with the trapezium rule, on the whole grid in one scripted call
+            integral_estimates = gaussian_entropy_integral(f_range, 1 / denominator, nu_cdf_offset, nu_cdf_slope, torch.zeros_like(sqrt_sm), sqrt_sm)
+            if self.debug_nan_checks and integral_estimates.isnan().any():
+                print('stap')
             # now estimate H2 using Monte Carlo
             H_2 = - integral_estimates.mean(axis = 1).reshape(-1, 1)
 
-            # calculate H_1 which is analytical
-            H_1_inner = sigma_m_sqrd_given_q.sqrt() * torch.sqrt(2 * torch.pi * torch.exp(torch.tensor(1)))
-            H_1_inner = H_1_inner.masked_fill(H_1_inner <= 0, self.num_stability)
-            H_1 = torch.log(H_1_inner)
+            # calculate H_1 which is analytical, the variance is already clamped away from zero
+            H_1 = 0.5 * torch.log(sigma_m_sqrd_given_q) + HALF_LOG_2PIE
 
             # finally calculate information gain by summing entropies
             H = H_1 - H_2
-            if H.isnan().any():
-                print('stop')
-            if (H == torch.inf).any():
-                print('AAAAAAA')
-            return H
+            if self.debug_nan_checks:
+                if H.isnan().any():
+                    print('stop')
+                if (H == torch.inf).any():
+                    print('AAAAAAA')
+            return H.cpu()
     
     def generate_max_samples(self, fidelity = 0):
-        sobol_gen = torch.quasirandom.SobolEngine(self.dim, scramble = True)
-        X_test_samples = sobol_gen.draw(100 * self.num_of_starts).double()
-        samples = self.model.generate_samples(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
+        X_test_samples = self.sobol_gen.draw(100 * self.num_of_starts, dtype = torch.float64)
+        samples = self.model.sample_posterior(X_test_samples, fidelity = fidelity, num_of_samples = self.num_of_fantasies)
         self.f_max_samples, _ = torch.max(samples, dim = 1)
 
 class TuRBO(MF_TuRBO):
-    def __init__(self, env, budget, cost_budget, num_of_latents=None, ranks=None, hp_update_frequency=None, num_of_starts=75, num_of_optim_epochs=25, beta=None, local_lipschitz=True, fidelity_thresholds=None, increasing_thresholds=False, fidelity_choice='variance_thresholds'):
-        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds, fidelity_choice)
+    def __init__(self, env, budget, cost_budget, num_of_latents=None, ranks=None, hp_update_frequency=None, num_of_starts=75, num_of_optim_epochs=25, beta=None, local_lipschitz=True, fidelity_thresholds=None, increasing_thresholds=False, fidelity_choice='variance_thresholds', use_gpu=False):
+        super().__init__(env, budget, cost_budget, num_of_latents, ranks, hp_update_frequency, num_of_starts, num_of_optim_epochs, beta, local_lipschitz, fidelity_thresholds, increasing_thresholds, fidelity_choice, use_gpu)
         self.num_of_latents = 1
         self.ranks = [1]
         # define model
@@ -494,8 +494,7 @@ def find_optimum(func, n_starts = 25, n_epochs = 100):
         optimiser.step()
 
         # make sure we are still within the bounds
-        for j, (lb, ub) in enumerate(zip(*bounds)):
-            X.data[..., j].clamp_(lb, ub) # need to do this on the data not X itself
+        X.data.clamp_(bounds[0], bounds[1]) # need to do this on the data not X itself
     
     final_evals = func.query_function_torch(X)
     best_eval = torch.max(final_evals)
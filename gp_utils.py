@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 import torch
 from gpytorch.priors import SmoothedBoxPrior
@@ -11,6 +12,8 @@ from torch.optim import Adam
 from typing import Any
 from torch import Tensor, dtype
 from gpytorch.distributions import MultivariateNormal, base_distributions
+from gpytorch.utils.cholesky import psd_safe_cholesky
+from gpytorch.utils.errors import NotPSDError
 import matplotlib.pyplot as plt
 
 '''
@@ -32,13 +35,19 @@ class BoTorchGP():
         self.noise_constraint = False
         self.lengthscale_dim = lengthscale_dim
         self.model = None
+        # copies of the model cast to other dtypes / devices, used for acquisition function evaluations
+        self.model_copies = {}
+        # cholesky factor and weights of the training data, used by posterior_cached
+        self.posterior_cache = None
         
     def fit_model(self, train_x, train_y, train_hyperparams = False, previous_hyperparams = None):
         '''
         This function fits the GP model with the given data.
         '''
-        # transform data to tensors
-        self.train_x = torch.tensor(train_x)
+        self.model_copies = {}
+        self.posterior_cache = None
+        # transform data to tensors, going through one contiguous numpy array
+        self.train_x = torch.tensor(np.asarray(train_x))
         train_y = np.array(train_y)
         self.train_y = torch.tensor(train_y).reshape(-1, 1)
         # define model
@@ -130,6 +139,8 @@ class BoTorchGP():
         
         # define optimiser
         optimiser = Adam([{'params': self.model.parameters()}], lr=0.01)
+        self.model_copies = {}
+        self.posterior_cache = None
 
         self.model.train()
 
@@ -181,19 +192,79 @@ class BoTorchGP():
                 'mean_module.constant': torch.tensor(hyperparams[3]).float()
             }
         self.model.initialize(**hypers)
+        self.model_copies = {}
+        self.posterior_cache = None
     
-    def posterior(self, test_x):
+    def posterior(self, test_x, dtype = None, device = None):
         '''
         Calculates the posterior of the GP, returning the mean and standard deviation at a corresponding set of points.
+        If dtype or device are given, a copy of the model cast to them is used, falling back to the float64 model
+        on the cpu if the Cholesky decomposition of the copy fails. Any other error is raised.
         '''
         if type(test_x) is not torch.Tensor:
             test_x = torch.tensor(test_x).double()
+        if (dtype is not None) or (device is not None):
+            try:
+                return self.posterior_copy(test_x, dtype, device)
+            except (torch.linalg.LinAlgError, NotPSDError):
+                out_device = test_x.device if device is None else device
+                mean, std = self.posterior(test_x.cpu().double())
+                return mean.to(out_device), std.to(out_device)
         self.model.eval()
         model_posterior = self.model(test_x)
         mean = model_posterior.mean
         std = model_posterior.stddev
         return mean, std
 
+    def posterior_cached(self, test_x):
+        '''
+        Calculates the same posterior as posterior, but caches the Cholesky factor of the training covariance and
+        the weights alpha = (K + noise * I)^-1 (y - m), so repeated calls only evaluate the test-train covariance.
+        The cache is cleared whenever the model or its hyper-parameters change.
+        '''
+        if type(test_x) is not torch.Tensor:
+            test_x = torch.tensor(test_x).double()
+        train_x = self.model.train_inputs[0]
+        if self.posterior_cache is None:
+            with torch.no_grad():
+                train_train_covar = self.model.covar_module(train_x).evaluate()
+                noise = self.model.likelihood.noise
+                train_train_covar = train_train_covar + noise * torch.eye(train_x.shape[0], dtype = train_x.dtype)
+                L = psd_safe_cholesky(train_train_covar)
+                residual = (self.model.train_targets - self.model.mean_module(train_x)).reshape(-1, 1)
+                alpha = torch.cholesky_solve(residual, L)
+            self.posterior_cache = (L, alpha)
+        L, alpha = self.posterior_cache
+        # only the test-train covariance depends on test_x
+        test_train_covar = self.model.covar_module(test_x, train_x).evaluate()
+        mean = self.model.mean_module(test_x) + (test_train_covar @ alpha).reshape(-1)
+        v = torch.linalg.solve_triangular(L, test_train_covar.T, upper = False)
+        var = self.model.covar_module(test_x, diag = True) - (v ** 2).sum(dim = 0)
+        std = var.clamp_min(1e-12).sqrt()
+        return mean, std
+
+    def posterior_copy(self, test_x, dtype = None, device = None):
+        '''
+        Calculates the posterior with a copy of the model cast to the given dtype and device. The copies are only
+        rebuilt after the model or its hyper-parameters change.
+        '''
+        if dtype is None:
+            dtype = torch.float64
+        if device is None:
+            device = test_x.device
+        device = torch.device(device)
+        if (dtype, device) not in self.model_copies:
+            model_copy = copy.deepcopy(self.model).to(device = device, dtype = dtype)
+            # drop any prediction caches copied over from the original model
+            model_copy.train()
+            self.model_copies[(dtype, device)] = model_copy
+        model_copy = self.model_copies[(dtype, device)]
+        model_copy.eval()
+        model_posterior = model_copy(test_x.to(device = device, dtype = dtype))
+        mean = model_posterior.mean
+        std = model_posterior.stddev
+        return mean, std
+
 class MultiTaskBoTorchGP():
     '''
     Our MultiTask GP implementation using GPyTorch.
@@ -209,34 +280,36 @@ class MultiTaskBoTorchGP():
         self.latent_ranks = ranks
         # initialize noise constraint
         self.noise_constraint = False
+        # cholesky factor and weights of the training data, used by posterior_cached
+        self.posterior_cache = None
         
     def fit_model(self, train_x, train_y, train_hyperparams = False, previous_hyperparams = None):
         '''
         This function fits the GP model with the given data.
         '''
+        self.posterior_cache = None
         # find dimension
         if train_x[-1] == []:
             dim = len(train_x[0][0])
         else:
             dim = len(train_x[-1][0])
-        # train_x is a list of lists, need to transform it into large vector form
-        num_task_0_obs = len(train_x[0])
-        
-        train_x_init = np.array(train_x[0]).reshape(num_task_0_obs, dim)
-        train_i_init = np.full(shape = (num_task_0_obs, 1), fill_value = 0)
-        train_y_init = np.array(train_y[0]).reshape(num_task_0_obs, 1)
-        for task_num in range(1, self.num_of_tasks):
+        # train_x is a list of lists of rows, need to transform it into large vector form
+        x_train_tasks = []
+        i_train_tasks = []
+        y_train_tasks = []
+        for task_num in range(self.num_of_tasks):
             # find the number of observations corresponding to task
             num_task_obs = len(train_x[task_num])
             # obtain task observations and reshape
-            x_train_task = np.array(train_x[task_num]).reshape(num_task_obs, dim)
-            train_x_init = np.concatenate((train_x_init, x_train_task), axis = 0)
+            x_train_tasks.append(np.array(train_x[task_num]).reshape(num_task_obs, dim))
             # create long vector containing task numbers
-            train_i_task = np.full(shape = (num_task_obs, 1), fill_value = task_num)
-            train_i_init = np.concatenate((train_i_init, train_i_task), axis = 0)
+            i_train_tasks.append(np.full(shape = (num_task_obs, 1), fill_value = task_num))
             # create long vector containing observations
-            train_y_task = np.array((train_y[task_num])).reshape(num_task_obs, 1)
-            train_y_init = np.concatenate((train_y_init, train_y_task), axis = 0)
+            y_train_tasks.append(np.array(train_y[task_num]).reshape(num_task_obs, 1))
+        # concatenate every task only once
+        train_x_init = np.concatenate(x_train_tasks, axis = 0)
+        train_i_init = np.concatenate(i_train_tasks, axis = 0)
+        train_y_init = np.concatenate(y_train_tasks, axis = 0)
         # transform data to tensors
         self.train_x = torch.tensor(train_x_init).double()
         self.train_i = torch.tensor(train_i_init).int()
@@ -320,6 +393,7 @@ class MultiTaskBoTorchGP():
         
         # define optimiser
         optimiser = Adam(self.model.parameters(), lr=0.1)
+        self.posterior_cache = None
 
         self.model.train()
         self.likelihood.train()
@@ -365,6 +439,7 @@ class MultiTaskBoTorchGP():
         else:
             hypers = hyperparams
         self.model.initialize(**hypers)
+        self.posterior_cache = None
     
     def posterior(self, test_x, test_i, with_likelihood = False):
         '''
@@ -389,6 +464,99 @@ class MultiTaskBoTorchGP():
         
         return mean, std
 
+    def posterior_cached(self, test_x, test_i):
+        '''
+        Calculates the same posterior as posterior, but caches the Cholesky factor of the training covariance and
+        the weights alpha = (K + noise * I)^-1 (y - m), so repeated calls only evaluate the test-train covariance.
+        The cache is cleared whenever the model or its hyper-parameters change.
+        '''
+        if type(test_x) is not torch.Tensor:
+            test_x = torch.tensor(test_x).double()
+        if type(test_i) is not torch.Tensor:
+            test_i = torch.tensor(test_i)
+        test_i = test_i.reshape(-1, 1).long()
+        train_x, train_i = self.model.train_inputs
+        train_i = train_i.reshape(-1, 1).long()
+        if self.posterior_cache is None:
+            self.build_posterior_cache()
+        L, alpha = self.posterior_cache
+        # only the test-train covariance depends on test_x
+        test_train_covar = self.model.cross_covariance(test_x, test_i, train_x, train_i)
+        mean = self.model.mean_module(test_x) + (test_train_covar @ alpha).reshape(-1)
+        v = torch.linalg.solve_triangular(L, test_train_covar.T, upper = False)
+        var = self.model.cross_covariance(test_x, test_i, test_x, test_i, diag = True) - (v ** 2).sum(dim = 0)
+        std = var.clamp_min(1e-12).sqrt()
+        return mean, std
+
+    def posterior_fidelities_cached(self, test_x, fidelities):
+        '''
+        Calculates the cached posterior of every fidelity in fidelities at the same points, stacking all of them into a
+        single test-train covariance and triangular solve. Returns the (F, N) means and standard deviations, and the
+        (F, N) posterior covariances between each fidelity and the first one at every point.
+        '''
+        if type(test_x) is not torch.Tensor:
+            test_x = torch.tensor(test_x).double()
+        num_of_points = test_x.shape[0]
+        num_of_fids = len(fidelities)
+        train_x, train_i = self.model.train_inputs
+        train_i = train_i.reshape(-1, 1).long()
+        if self.posterior_cache is None:
+            self.build_posterior_cache()
+        L, alpha = self.posterior_cache
+        # the points are repeated once per fidelity, so every fidelity is a contiguous block
+        stacked_x = test_x.repeat(num_of_fids, 1)
+        stacked_i = torch.as_tensor(fidelities).long().repeat_interleave(num_of_points).reshape(-1, 1)
+        test_train_covar = self.model.cross_covariance(stacked_x, stacked_i, train_x, train_i)
+        mean = self.model.mean_module(stacked_x) + (test_train_covar @ alpha).reshape(-1)
+        v = torch.linalg.solve_triangular(L, test_train_covar.T, upper = False)
+        var = self.model.cross_covariance(stacked_x, stacked_i, stacked_x, stacked_i, diag = True) - (v ** 2).sum(dim = 0)
+        std = var.clamp_min(1e-12).sqrt()
+        # covariance of every fidelity with the first one, reusing the same solve
+        first_i = stacked_i[:num_of_points].repeat(num_of_fids, 1)
+        prior_cross = self.model.cross_covariance(stacked_x, stacked_i, stacked_x, first_i, diag = True)
+        v = v.reshape(-1, num_of_fids, num_of_points)
+        cross = prior_cross.reshape(num_of_fids, num_of_points) - (v * v[:, :1, :]).sum(dim = 0)
+        return mean.reshape(num_of_fids, num_of_points), std.reshape(num_of_fids, num_of_points), cross
+
+    def build_posterior_cache(self):
+        '''
+        Caches the Cholesky factor of the training covariance, including the noise of each task, and the weights alpha.
+        '''
+        train_x, train_i = self.model.train_inputs
+        train_i = train_i.reshape(-1, 1).long()
+        with torch.no_grad():
+            train_train_covar = self.model.cross_covariance(train_x, train_i, train_x, train_i)
+            # the noise of each training point is the noise of its task
+            noise = self.model.likelihood.noise.reshape(-1)[train_i.reshape(-1)]
+            train_train_covar = train_train_covar + torch.diag(noise)
+            L = psd_safe_cholesky(train_train_covar)
+            residual = (self.model.train_targets - self.model.mean_module(train_x)).reshape(-1, 1)
+            alpha = torch.cholesky_solve(residual, L)
+        self.posterior_cache = (L, alpha)
+
+    def sample_posterior(self, X, fidelity = 0, num_of_samples = 1):
+        '''
+        Draws samples of the posterior at X for the given fidelity. The posterior mean and covariance are built from the
+        cached Cholesky factor of the training data, so the training covariance is not solved again.
+        '''
+        if self.posterior_cache is None:
+            self.build_posterior_cache()
+        L, alpha = self.posterior_cache
+        train_x, train_i = self.model.train_inputs
+        train_i = train_i.reshape(-1, 1).long()
+        i = torch.full(size = (X.shape[0], 1), fill_value = fidelity).long()
+        # the model is left in eval mode, as generate_samples does, since the callers rely on it for later predictions
+        self.model.eval()
+        with torch.no_grad():
+            test_train_covar = self.model.cross_covariance(X, i, train_x, train_i)
+            mean = self.model.mean_module(X) + (test_train_covar @ alpha).reshape(-1)
+            v = torch.linalg.solve_triangular(L, test_train_covar.T, upper = False)
+            covar = self.model.cross_covariance(X, i, X, i) - v.T @ v
+            # gpytorch picks the root decomposition, cholesky for small sets of points and lanczos for large ones
+            posterior_distribution = MultivariateNormal(mean, gpytorch.lazify(covar).add_jitter(1e-8))
+            samples = posterior_distribution.sample(torch.Size((num_of_samples,)))
+        return samples
+
     def generate_samples(self, X, fidelity = 0, num_of_samples = 1):
         posterior_points = X.shape[0]
         i = torch.full(size = (posterior_points,), fill_value = fidelity).reshape(-1, 1).int()
@@ -430,9 +598,9 @@ class MultitaskGPModel(gpytorch.models.ExactGP):
         
         for latent in range(1, self.num_of_latents):
             # Get input-input covariance
-            exec(f'covar_x = self.covar_module_{latent}(x)')
+            covar_x = getattr(self, f'covar_module_{latent}')(x)
             # Get task-task covariance
-            exec(f'covar_i = self.task_covar_module_{latent}(i)')
+            covar_i = getattr(self, f'task_covar_module_{latent}')(i)
             # add the new covariance
             covar = covar + covar_x.mul(covar_i)
         
@@ -448,14 +616,29 @@ class MultitaskGPModel(gpytorch.models.ExactGP):
         
         for latent in range(1, self.num_of_latents):
             # Get input-input covariance
-            exec(f'covar_x = self.covar_module_{latent}(x)')
+            covar_x = getattr(self, f'covar_module_{latent}')(x)
             # Get task-task covariance
-            exec(f'covar_i = self.task_covar_module_{latent}(i)')
+            covar_i = getattr(self, f'task_covar_module_{latent}')(i)
             # add the new covariance
             covar = covar + covar_x.mul(covar_i)
         
         return covar
 
+    def cross_covariance(self, x1, i1, x2, i2, diag = False):
+        # same sum as in forward, evaluated densely between two sets of points (or only its diagonal)
+        covar = 0
+        for latent in range(self.num_of_latents):
+            # Get input-input covariance
+            covar_x = getattr(self, f'covar_module_{latent}')(x1, x2, diag = diag)
+            # Get task-task covariance
+            covar_i = getattr(self, f'task_covar_module_{latent}')(i1, i2, diag = diag)
+            if not diag:
+                covar_x, covar_i = covar_x.evaluate(), covar_i.evaluate()
+            # add the new covariance
+            covar = covar + covar_x * covar_i
+        
+        return covar
+
 class MultitaskGPModelICM(gpytorch.models.ExactGP):
     def __init__(self, train_x, train_y, likelihood, num_tasks = 2, rank = 2):
         super(MultitaskGPModelICM, self).__init__(train_x, train_y, likelihood)
@@ -543,4 +726,4 @@ class MultitaskGaussianLikelihood(_GaussianLikelihoodBase):
         mean, covar = function_dist.mean, function_dist.lazy_covariance_matrix
         noise_covar = self._shaped_noise_covar(mean.shape, *params, **kwargs).squeeze(0)
         full_covar = covar + noise_covar
-        return function_dist.__class__(mean, full_covar)
\ No newline at end of file
+        return function_dist.__class__(mean, full_covar)
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+import torch
+from gpytorch.utils.errors import NotPSDError
+from gp_utils import BoTorchGP, MultiTaskBoTorchGP
+
+'''
+Checks the hand-written posteriors of gp_utils against the gpytorch posterior on random data.
+'''
+
+NUM_OF_POINTS = 20
+DIM = 2
+ATOL = 1e-6
+
+@pytest.fixture(autouse = True)
+def seed():
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+@pytest.fixture
+def test_x():
+    return torch.rand(NUM_OF_POINTS, DIM).double()
+
+@pytest.fixture
+def gp():
+    gp = BoTorchGP(lengthscale_dim = DIM)
+    train_x = np.random.uniform(size = (NUM_OF_POINTS, DIM))
+    gp.fit_model(train_x, np.sin(5 * train_x.sum(axis = 1)))
+    gp.set_hyperparams((0.5, torch.tensor([0.3 for _ in range(DIM)]), 1e-3, 0.1))
+    return gp
+
+@pytest.fixture
+def mt_gp():
+    # two tasks, with a different noise for each of them
+    mt_gp = MultiTaskBoTorchGP(num_of_tasks = 2, num_of_latents = 2, ranks = [2, 2], lengthscale_dim = DIM)
+    train_x = [list(np.random.uniform(size = (NUM_OF_POINTS, DIM))) for _ in range(2)]
+    train_y = [list(np.sin(5 * np.sum(x, axis = 1)) + 0.1 * task) for task, x in enumerate(train_x)]
+    mt_gp.fit_model(train_x, train_y)
+    mt_gp.model.likelihood.noise = torch.tensor([1e-3, 5e-2]).double()
+    mt_gp.posterior_cache = None
+    return mt_gp
+
+def test_posterior_cached(gp, test_x):
+    with torch.no_grad():
+        mean, std = gp.posterior(test_x)
+        mean_cached, std_cached = gp.posterior_cached(test_x)
+    assert torch.allclose(mean, mean_cached, atol = ATOL)
+    assert torch.allclose(std, std_cached, atol = ATOL)
+
+def test_posterior_float32_copy(gp, test_x):
+    with torch.no_grad():
+        mean, std = gp.posterior(test_x)
+        mean_32, std_32 = gp.posterior(test_x, dtype = torch.float32)
+    assert mean_32.dtype == torch.float32
+    assert std_32.dtype == torch.float32
+    assert torch.allclose(mean, mean_32.double(), atol = 1e-3)
+    assert torch.allclose(std, std_32.double(), atol = 1e-3)
+    # the copy is cached until the hyper-parameters change
+    assert len(gp.model_copies) == 1
+    gp.set_hyperparams((0.5, torch.tensor([0.2 for _ in range(DIM)]), 1e-3, 0.1))
+    assert len(gp.model_copies) == 0
+
+@pytest.mark.parametrize('error', [torch.linalg.LinAlgError, NotPSDError])
+def test_posterior_copy_fallback(gp, test_x, monkeypatch, error):
+    def failing_posterior_copy(*args, **kwargs):
+        raise error('cholesky failed')
+    monkeypatch.setattr(gp, 'posterior_copy', failing_posterior_copy)
+    with torch.no_grad():
+        mean, std = gp.posterior(test_x)
+        mean_fallback, std_fallback = gp.posterior(test_x, dtype = torch.float32)
+    # the fallback is the float64 model
+    assert mean_fallback.dtype == torch.float64
+    assert torch.allclose(mean, mean_fallback, atol = ATOL)
+    assert torch.allclose(std, std_fallback, atol = ATOL)
+
+def test_posterior_copy_other_errors_raise(gp, test_x, monkeypatch):
+    def failing_posterior_copy(*args, **kwargs):
+        raise ValueError('not a cholesky failure')
+    monkeypatch.setattr(gp, 'posterior_copy', failing_posterior_copy)
+    with pytest.raises(ValueError):
+        gp.posterior(test_x, dtype = torch.float32)
+
+def test_multitask_posterior_cached(mt_gp, test_x):
+    with torch.no_grad():
+        for task in range(2):
+            test_i = torch.full((NUM_OF_POINTS, 1), task)
+            mean, std = mt_gp.posterior(test_x, test_i)
+            mean_cached, std_cached = mt_gp.posterior_cached(test_x, test_i)
+            assert torch.allclose(mean, mean_cached, atol = ATOL)
+            assert torch.allclose(std, std_cached, atol = ATOL)
+
+def test_multitask_posterior_fidelities_cached(mt_gp, test_x):
+    with torch.no_grad():
+        means, stds, cross_covars = mt_gp.posterior_fidelities_cached(test_x, [0, 1])
+        for task in range(2):
+            mean, std = mt_gp.posterior(test_x, torch.full((NUM_OF_POINTS, 1), task))
+            assert torch.allclose(mean, means[task], atol = ATOL)
+            assert torch.allclose(std, stds[task], atol = ATOL)
+        # the covariance of task 1 with task 0 from the joint gpytorch posterior
+        joint_i = torch.cat((torch.zeros(NUM_OF_POINTS, 1), torch.ones(NUM_OF_POINTS, 1)))
+        joint_covar = mt_gp.model(test_x.repeat(2, 1), joint_i).covariance_matrix
+        cross_covar = joint_covar[NUM_OF_POINTS:, :NUM_OF_POINTS].diag()
+        assert torch.allclose(cross_covar, cross_covars[1], atol = ATOL)
+
+def test_multitask_sample_posterior(mt_gp, test_x):
+    # the samples should be centred on the posterior mean, up to the monte carlo error
+    num_of_samples = 10000
+    with torch.no_grad():
+        samples = mt_gp.sample_posterior(test_x, fidelity = 1, num_of_samples = num_of_samples)
+        mean, std = mt_gp.posterior(test_x, torch.ones(NUM_OF_POINTS, 1))
+    assert ((samples.mean(dim = 0) - mean).abs() <= 5 * std / np.sqrt(num_of_samples) + ATOL).all()
+    assert torch.allclose(samples.std(dim = 0), std, rtol = 0.1, atol = 1e-3)
+
+def test_multitask_posterior_uses_every_latent(mt_gp, test_x):
+    # the hyper-parameters of the latents after the first one must change the posterior
+    with torch.no_grad():
+        means, stds, _ = mt_gp.posterior_fidelities_cached(test_x, [0, 1])
+        mt_gp.model.covar_module_1.lengthscale = 2 * mt_gp.model.covar_module_1.lengthscale
+        mt_gp.posterior_cache = None
+        new_means, new_stds, _ = mt_gp.posterior_fidelities_cached(test_x, [0, 1])
+        # and the cached posterior still matches the gpytorch posterior
+        for task in range(2):
+            mean, std = mt_gp.posterior(test_x, torch.full((NUM_OF_POINTS, 1), task))
+            assert torch.allclose(mean, new_means[task], atol = ATOL)
+            assert torch.allclose(std, new_stds[task], atol = ATOL)
+    assert not torch.allclose(means, new_means, atol = ATOL)
+    assert not torch.allclose(stds, new_stds, atol = ATOL)